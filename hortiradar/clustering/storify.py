@@ -11,12 +11,12 @@ from scipy.sparse import csgraph
 from hortiradar.clustering import Config, ExtendedTweet, Cluster, Stories
 from hortiradar.clustering.util import round_time
 from hortiradar.database import get_db, get_keywords
+from hortiradar.database.partitions import find
 
 
 db = get_db()
 groups = [g["name"] for g in db.groups.find({}, projection={"name": True, "_id": False})]
 storiesdb = db.stories
-tweetsdb = db.tweets
 
 keywords = get_keywords(local=True)
 
@@ -32,7 +32,7 @@ def get_filt_tokens(tweet):
     return [t.lemma for t in tweet.tokens if not t.filter_token()]
 
 def get_tweets(start, end, key, keytype):
-    jsontweets = tweetsdb.find({
+    jsontweets = find(db, {
         keytype: key,
         "datetime": {"$gte": start, "$lt": end}
     }, projection={
@@ -1,27 +1,51 @@
-from collections import Counter
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
-from time import time
+from itertools import chain, islice
+import zlib
 
 import falcon
+import msgpack
 import ujson as json
-
-from keywords import get_db, get_keywords
+from bson import ObjectId
+from bson.errors import InvalidId
+from redis import StrictRedis
+
+import api_cache
+import archive
+import metrics
+import partitions
+from keywords import announce_keywords, get_db, get_keywords, get_keywords_version, make_snapshot, watch_keywords
+from rollups import (bin_expr, ceil_hour, floor_hour, read_bins, read_keyword_counts, step_bases,
+                     update_rollups, update_rollups_spam)
 from hortiradar import admins, users, time_format
 from hortiradar.database import stop_words
+from hortiradar.database.statistics import count_tweets
 from hortiradar.clustering import Config
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 db = get_db()
-tweets = db.tweets
 groups = db.groups
+rollups = db.rollups
+
+redis = StrictRedis()
 
-KEYWORDS = get_keywords(local=True)
-keywords_sync_time = time()
+# the keyword registry, swapped for a new snapshot when the groups change
+registry = make_snapshot(get_keywords_version(redis), get_keywords(local=True))
 
 spam_level = Config.getfloat("database:parameters", "spam_level")
 
 def get_dates(req, resp, resource, params):
     """Parse the `start` and `end` datetime parameters."""
+    params["start"], params["end"] = parse_dates(req)
+
+def parse_dates(req):
     try:
         today = datetime.today()
         today = datetime(today.year, today.month, today.day)
@@ -35,18 +59,158 @@ def get_dates(req, resp, resource, params):
             end = datetime.strptime(end, time_format)
         else:
             end = today
-        params["start"] = start
-        params["end"] = end
+        return start, end
     except ValueError:
         msg = "Invalid datetime format string, use: %s" % time_format
         raise falcon.HTTPBadRequest("Bad request", msg)
 
+def load_keywords(version):
+    """Swap in a snapshot of the keyword registry when there's a newer version."""
+    global registry
+    if version > registry.version:
+        registry = make_snapshot(version, get_keywords(local=True))
+
+watch_keywords(redis, load_keywords)
+
+def parse_step(req):
+    """Parse the mandatory `step` parameter: number of seconds as an integer."""
+    return to_step(req.get_param("step"))
+
+def parse_steps(req):
+    """Parse the mandatory `step` parameter as a comma separated list of steps."""
+    return [to_step(step) for step in req.get_param_as_list("step") or [None]]
+
+def to_step(step):
+    try:
+        dt = timedelta(seconds=int(step))
+        if dt.total_seconds() <= 0:
+            raise ValueError
+        return dt
+    except (ValueError, TypeError):
+        msg = "Invalid step: step is an integer of the number of seconds."
+        raise falcon.HTTPBadRequest("Bad request", msg)
+
 def want_spam(req):
     return req.get_param("spam") == '1'
 
 def is_spam(t):
     return t.get("spam") is not None and t["spam"] > spam_level
 
+# the opposite of is_spam in a query, also matches tweets without a spam score
+not_spam = {"$not": {"$gt": spam_level}}
+
+def keyword_query(req, keyword, start, end):
+    """The query for the tweets with keyword from start to end, without spam
+    unless the client asks for it with `spam=1`."""
+    query = {"keywords": keyword, "datetime": {"$gte": start, "$lt": end}}
+    if not want_spam(req):
+        query["spam"] = not_spam
+    return query
+
+# the largest page of tweets, a larger limit is lowered to it
+MAX_PAGE_SIZE = 10000
+
+def find_tweets(req, resp, query, projection):
+    """Find the tweets matching the query. With the `limit` GET parameter only
+    returns a page of at most limit tweets, and at most MAX_PAGE_SIZE. The next
+    page starts after the cursor in the X-Next-Cursor response header, pass it
+    in with the `after` GET parameter. There are no more pages when this header
+    is missing.
+    """
+    limit = req.get_param("limit")
+    if limit is None:
+        return partitions.find(db, query, projection=projection)
+    try:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        msg = "Invalid limit: limit is a positive integer."
+        raise falcon.HTTPBadRequest("Bad request", msg)
+    limit = min(limit, MAX_PAGE_SIZE)
+    after = req.get_param("after")
+    if after:
+        dt, _id = decode_cursor(after)
+        query["$or"] = [{"datetime": {"$gt": dt}}, {"datetime": dt, "_id": {"$gt": _id}}]
+    page_projection = dict(projection, _id=True, datetime=True)
+    tw = list(partitions.find(db, query, projection=page_projection, sort=[("datetime", 1), ("_id", 1)], limit=limit))
+    if len(tw) == limit:
+        resp.set_header("X-Next-Cursor", encode_cursor(tw[-1]["datetime"], tw[-1]["_id"]))
+    for t in tw:
+        for key in ["_id", "datetime"]:
+            if not projection.get(key, key == "_id"):  # mongo includes _id by default
+                del t[key]
+    return tw
+
+cursor_time_format = "%Y-%m-%dT%H:%M:%S.%f"
+
+def encode_cursor(dt, _id):
+    cursor = "{}|{}".format(dt.strftime(cursor_time_format), _id)
+    return urlsafe_b64encode(cursor.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        dt, _id = urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.strptime(dt, cursor_time_format), ObjectId(_id)
+    except (Base64Error, UnicodeError, ValueError, InvalidId):
+        msg = "Invalid cursor: use the X-Next-Cursor header of the previous page."
+        raise falcon.HTTPBadRequest("Bad request", msg)
+
+MSGPACK = "application/msgpack"
+MSGPACK_STREAM = "application/x-msgpack-stream"  # msgpack objects one after the other
+NDJSON = "application/x-ndjson"
+
+def send(req, resp, data):
+    """Responds with the data as JSON, or as MessagePack when the client
+    prefers `Accept: application/msgpack`."""
+    if req.client_prefers([falcon.MEDIA_JSON, MSGPACK]) == MSGPACK:
+        resp.content_type = MSGPACK
+        resp.data = msgpack.packb(data, use_bin_type=True)
+    else:
+        resp.body = json.dumps(data)
+
+def stream_list(req, resp, items):
+    """Streams the items as a JSON array, or as newline delimited JSON when the
+    client asks for it with `Accept: application/x-ndjson` or `format=ndjson`.
+    Clients that prefer MessagePack get a stream of MessagePack objects.
+    The items can be a generator over a cursor, so they're never all in memory.
+    """
+    media_type = req.client_prefers([falcon.MEDIA_JSON, NDJSON, MSGPACK, MSGPACK_STREAM])
+    if req.get_param("format") == "ndjson" or media_type == NDJSON:
+        resp.content_type = NDJSON
+        resp.stream = json_chunks(items, ndjson=True)
+    elif media_type in (MSGPACK, MSGPACK_STREAM):
+        resp.content_type = MSGPACK_STREAM
+        resp.stream = msgpack_chunks(items)
+    else:
+        resp.stream = json_chunks(items)
+
+def json_chunks(items, ndjson=False, chunk_size=500):
+    """Yields the items JSON encoded in chunks of chunk_size items."""
+    items = iter(items)
+    chunk = list(islice(items, chunk_size))
+    if ndjson:
+        while chunk:
+            yield "".join(json.dumps(item) + "\n" for item in chunk).encode("utf-8")
+            chunk = list(islice(items, chunk_size))
+    else:
+        yield b"["
+        sep = ""
+        while chunk:
+            yield (sep + ",".join(json.dumps(item) for item in chunk)).encode("utf-8")
+            sep = ","
+            chunk = list(islice(items, chunk_size))
+        yield b"]"
+
+def msgpack_chunks(items, chunk_size=500):
+    """Yields the items MessagePack encoded in chunks of chunk_size items."""
+    packer = msgpack.Packer(use_bin_type=True)
+    items = iter(items)
+    chunk = list(islice(items, chunk_size))
+    while chunk:
+        yield b"".join(packer.pack(item) for item in chunk)
+        chunk = list(islice(items, chunk_size))
+
 
 class KeywordsResource:
     @falcon.before(get_dates)
@@ -55,39 +219,67 @@ class KeywordsResource:
         Returns a sorted list with the keywords and their counts.
         Takes the "group" GET parameters for the keyword group.
         """
-        global KEYWORDS, keywords_sync_time
-        if (time() - keywords_sync_time) > 60 * 60:
-            KEYWORDS = get_keywords(local=True)
-            keywords_sync_time = time()
-        query = {
-            "num_keywords": {"$gt": 0},
-            "datetime": {"$gte": start, "$lt": end}
-        }
         group = req.get_param("group")
-        if group:
-            del query["num_keywords"]
-            query["groups"] = group
-        tw = tweets.find(query, projection={"keywords": True, "_id": False})
-        counts = Counter()
-        for t in tw:
-            kws = t["keywords"]
+        # whole hours come from the rollups, only the partial hours at the edges are counted
+        hours_start, hours_end = ceil_hour(start), floor_hour(end)
+        if hours_start < hours_end:
+            counts = Counter(read_keyword_counts(rollups, hours_start, hours_end, group))
             if group:
-                keywords = []
-                for kw in kws:
-                    if kw in KEYWORDS:
-                        if group in KEYWORDS[kw].groups:
-                            keywords.append(kw)
-                kws = keywords
-            counts.update(kws)
+                group_keywords = set(registry.groups.get(group, []))
+                counts = Counter({kw: c for kw, c in counts.items() if kw in group_keywords})
+            counts.update(count_keywords(start, hours_start, group))
+            counts.update(count_keywords(hours_end, end, group))
+        else:
+            counts = count_keywords(start, end, group)
         data = [{"keyword": kw, "count": c} for kw, c in counts.most_common()]
-        resp.body = json.dumps(data)
+        send(req, resp, data)
+
+def count_keywords(start, end, group=None):
+    """Count the keywords of the tweets from start to end, in the archive and MongoDB."""
+    counts = Counter()
+    archive_end = archive.archived_until(db)
+    if start < min(end, archive_end):
+        # the archive has no groups, but the tweets with keywords of a group are in it
+        group_keywords = set(registry.groups.get(group, [])) if group else None
+        counts = archive.count_keywords(start, min(end, archive_end), group_keywords)
+        start = archive_end
+    if start >= end:
+        return counts
+    match = {"datetime": {"$gte": start, "$lt": end}}
+    if group:
+        match["groups"] = group
+    else:
+        match["num_keywords"] = {"$gt": 0}
+    pipeline = [
+        {"$match": match},
+        {"$project": {"keywords": True, "_id": False}},
+        {"$unwind": "$keywords"},
+    ]
+    if group:
+        # tweets in the group can also have keywords from other groups
+        group_keywords = registry.groups.get(group, [])
+        pipeline.append({"$match": {"keywords": {"$in": group_keywords}}})
+    pipeline += [
+        {"$group": {"_id": "$keywords", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+    ]
+    for r in partitions.aggregate(db, pipeline):
+        counts[r["_id"]] += r["count"]
+    return counts
 
 class GroupsResource:
     def on_get(self, req, resp):
-        """The groups currently tagged in the database."""
+        """The groups currently tagged in the database. With `expand=keywords`
+        returns the groups with their keywords, as objects with the `name` and
+        `keywords` keys."""
+        if req.get_param("expand") == "keywords":
+            gs = groups.find({}, projection={"name": True, "keywords": True, "_id": False})
+            data = [{"name": g["name"], "keywords": g.get("keywords", [])} for g in gs]
+            send(req, resp, data)
+            return
         gs = groups.find({}, projection={"name": True, "_id": False})
         group_names = [g["name"] for g in gs]
-        resp.body = json.dumps(group_names)
+        send(req, resp, group_names)
 
     def on_post(self, req, resp):
         """Add a new group to the system."""
@@ -97,6 +289,12 @@ class GroupsResource:
         if name not in group_names and len(name) > 0:
             group = {"name": name}
             groups.insert_one(group)
+            announce_keywords(redis)
+
+class RegistryResource:
+    def on_get(self, req, resp):
+        """The version of the keyword registry, incremented on every change of the groups."""
+        send(req, resp, {"version": get_keywords_version(redis)})
 
 class GroupResource:
     def on_get(self, req, resp, group):
@@ -106,7 +304,7 @@ class GroupResource:
             data = g["keywords"]
         except KeyError:
             data = []
-        resp.body = json.dumps(data)
+        send(req, resp, data)
 
     def on_put(self, req, resp, group):
         """Update group wordlist."""
@@ -115,86 +313,95 @@ class GroupResource:
             raise falcon.HTTPNotFound()
         keywords = json.load(req.bounded_stream)
         groups.update_one({"name": group}, {"$set": {"keywords": keywords}})
+        announce_keywords(redis)
 
     def on_delete(self, req, resp, group):
         groups.delete_one({"name": group})
+        announce_keywords(redis)
+
+# the fields of tweets that can be selected with the `fields` GET parameter of
+# /keywords/{keyword}, and the paths of the tweet documents that they include
+KEYWORD_FIELDS = {
+    "id_str": ["tweet.id_str"],
+    "created_at": ["tweet.created_at"],
+    "user": ["tweet.user.id_str", "tweet.user.screen_name"],
+    "retweet": ["tweet.retweeted_status.user.id_str", "tweet.retweeted_status.user.screen_name",
+                "tweet.retweeted_status.id_str", "tweet.retweeted_status.retweet_count"],
+    "reply": ["tweet.in_reply_to_user_id_str", "tweet.in_reply_to_screen_name"],
+    "entities": ["tweet.entities"],
+    "tokens": ["tokens"],
+    "lemmas": ["tokens.lemma"],
+    "words": ["tokens.text"],
+    "pos": ["tokens.pos", "tokens.posprob"],
+    "spam": ["spam"],
+}
+
+def get_projection(req, resp, resource, params):
+    """Parse the `fields` parameter: a comma separated list of KEYWORD_FIELDS."""
+    fields = req.get_param_as_list("fields") or list(KEYWORD_FIELDS)
+    for field in fields:
+        if field not in KEYWORD_FIELDS:
+            msg = "Invalid field: {}, choose from: {}".format(field, ", ".join(KEYWORD_FIELDS))
+            raise falcon.HTTPBadRequest("Bad request", msg)
+    params["projection"] = fields_projection(fields)
+
+def fields_projection(fields):
+    paths = set()
+    for field in fields:
+        paths.update(KEYWORD_FIELDS[field])
+    # mongo doesn't allow a path together with its sub-paths
+    paths = [p for p in paths if not any(p.startswith(q + ".") for q in paths)]
+    projection = {p: True for p in paths}
+    projection["_id"] = False
+    return projection
 
 class KeywordResource:
     @falcon.before(get_dates)
-    def on_get(self, req, resp, keyword, start, end):
-        """NLP analysis of the tweet text, entities and timestamp of tweets matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={
-            "tweet.id_str": True, "tokens": True, "tweet.entities": True, "tweet.created_at": True,
-            "tweet.user.id_str": True, "tweet.user.screen_name": True, "tweet.retweeted_status.user.id_str": True,
-            "tweet.retweeted_status.user.screen_name": True, "tweet.retweeted_status.id_str": True,
-            "tweet.in_reply_to_user_id_str": True, "tweet.in_reply_to_screen_name": True,
-            "tweet.retweeted_status.retweet_count": True,
-            "spam": True, "_id": False
-        })
-        if not want_spam(req):
-            tw = [t for t in tw if not is_spam(t)]
-        resp.body = json.dumps(tw)
+    @falcon.before(get_projection)
+    def on_get(self, req, resp, keyword, start, end, projection):
+        """NLP analysis of the tweet text, entities and timestamp of tweets matching keyword.
+        Takes the "fields" GET parameter to select only some of the data.
+        """
+        tw = find_tweets(req, resp, keyword_query(req, keyword, start, end), projection)
+        stream_list(req, resp, tw)
 
 class KeywordIdsResource:
     @falcon.before(get_dates)
     def on_get(self, req, resp, keyword, start, end):
         """A list of the tweet id's matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={"tweet.id_str": True, "spam": True, "_id": False})
-        if want_spam(req):
-            data = [t["tweet"]["id_str"] for t in tw]
-        else:
-            data = [t["tweet"]["id_str"] for t in tw if not is_spam(t)]
-        resp.body = json.dumps(data)
+        tw = find_tweets(req, resp, keyword_query(req, keyword, start, end),
+                         {"tweet.id_str": True, "_id": False})
+        data = (t["tweet"]["id_str"] for t in tw)
+        stream_list(req, resp, data)
 
 class KeywordMediaResource:
     @falcon.before(get_dates)
     def on_get(self, req, resp, keyword, start, end):
         """List of the media entities for tweets matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={"tweet.id_str": True, "tweet.entities.media": True, "spam": True, "_id": False})
+        tw = find_tweets(req, resp, keyword_query(req, keyword, start, end),
+                         {"tweet.id_str": True, "tweet.entities.media": True, "_id": False})
         # alternative:  "tweet.entities.media": {"$ne": None} in query
-        if want_spam(req):
-            data = [t["tweet"] for t in tw if "media" in t["tweet"]["entities"]]
-        else:
-            data = [t["tweet"] for t in tw if "media" in t["tweet"]["entities"] if not is_spam(t)]
-        resp.body = json.dumps(data)
+        data = (t["tweet"] for t in tw if "media" in t["tweet"]["entities"])
+        stream_list(req, resp, data)
 
 class KeywordUrlsResource:
     @falcon.before(get_dates)
     def on_get(self, req, resp, keyword, start, end):
         """List of the urls entities for tweets matching keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end}
-        }, projection={"tweet.entities.urls": True, "tweet.id_str": True, "spam": True, "_id": False})
+        tw = find_tweets(req, resp, keyword_query(req, keyword, start, end),
+                         {"tweet.entities.urls": True, "tweet.id_str": True, "_id": False})
         # "tweet.entities.urls": {"$ne": []}
-        if want_spam(req):
-            data = [t["tweet"] for t in tw if t["tweet"]["entities"]["urls"]]
-        else:
-            data = [t["tweet"] for t in tw if t["tweet"]["entities"]["urls"] if not is_spam(t)]
-        resp.body = json.dumps(data)
+        data = (t["tweet"] for t in tw if t["tweet"]["entities"]["urls"])
+        stream_list(req, resp, data)
 
 class KeywordTextsResource:
     @falcon.before(get_dates)
     def on_get(self, req, resp, keyword, start, end):
         "List of the tweet texts of keyword."
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"tweet.text": True, "tweet.id_str": True, "spam": True, "_id": False})
-        if want_spam(req):
-            data = [t["tweet"] for t in tw]
-        else:
-            data = [t["tweet"] for t in tw if not is_spam(t)]
-        resp.body = json.dumps(data)
+        tw = find_tweets(req, resp, keyword_query(req, keyword, start, end),
+                         {"tweet.text": True, "tweet.id_str": True, "_id": False})
+        data = (t["tweet"] for t in tw)
+        stream_list(req, resp, data)
 
 class KeywordUsersResource:
     @falcon.before(get_dates)
@@ -202,42 +409,41 @@ class KeywordUsersResource:
         """List of users who tweeted keyword.
         Returns a sorted list with tuples of the user id and the number of tweets.
         """
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"tweet.user.id_str": True, "spam": True, "_id": False})
+        # the months before the end of the archive are read from the archive
+        archive_end = archive.archived_until(db)
         counts = Counter()
-        skip_spam = not want_spam(req)
+        if start < archive_end:
+            counts = archive.count_users(keyword, start, min(end, archive_end), not want_spam(req))
+        tw = partitions.find(db, keyword_query(req, keyword, max(start, archive_end), end),
+                             projection={"tweet.user.id_str": True, "_id": False})
         for t in tw:
-            if skip_spam and is_spam(t):
-                continue
             counts[t["tweet"]["user"]["id_str"]] += 1
         data = [{"id_str": id_str, "count": c} for id_str, c in counts.most_common()]
-        resp.body = json.dumps(data)
+        send(req, resp, data)
 
 class KeywordWordcloudResource:
     @falcon.before(get_dates)
     def on_get(self, req, resp, keyword, start, end):
         """Returns words and their counts in all tweets for keyword."""
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"tokens.lemma": True, "spam": True, "_id": False})
+        archive_end = archive.archived_until(db)
         words = Counter()
-        skip_spam = not want_spam(req)
+        if start < archive_end:
+            lemmas = archive.count_lemmas(keyword, start, min(end, archive_end), not want_spam(req))
+            words.update({l: c for (l, c) in lemmas.items() if l.lower() not in stop_words})
+        tw = partitions.find(db, keyword_query(req, keyword, max(start, archive_end), end),
+                             projection={"tokens.lemma": True, "_id": False})
         for t in tw:
-            if skip_spam and is_spam(t):
-                continue
             lemmas = [token["lemma"] for token in t["tokens"]]
             words.update([l for l in lemmas if l.lower() not in stop_words])
         data = [{"word": w, "count": c} for w, c in words.most_common()]
-        resp.body = json.dumps(data)
+        send(req, resp, data)
 
 class KeywordTimeSeriesResource:
     @falcon.before(get_dates)
     def on_get(self, req, resp, keyword, start, end):
         """Returns a time series with number of tweets from start to end in bins of step.
-        Step is a mandatory GET parameter: number of seconds as an integer.
+        Step is a mandatory GET parameter: number of seconds as an integer, or a
+        comma separated list of them for multiple time series at once.
 
         Returns an object where:
             - start is the beginning of the first bin
@@ -245,62 +451,148 @@ class KeywordTimeSeriesResource:
             - step is the requested time bin size
             - bins is the number of filled bins
             - series is an object where the keys are the bin numbers and the values the counts
+        With multiple steps returns a list of these objects, one for every step.
         """
-        tw = tweets.find({
-            "keywords": keyword,
-            "datetime": {"$gte": start, "$lt": end},
-        }, projection={"datetime": True, "_id": False}).sort("datetime")
-        step = req.get_param("step")
-        try:
-            dt = timedelta(seconds=int(step))
-        except (ValueError, TypeError):
-            msg = "Invalid step: step is an integer of the number of seconds."
-            raise falcon.HTTPBadRequest("Bad request", msg)
-        try:
-            first = tw[0]["datetime"]
-        except IndexError:
-            # empty time series
-            data = {
-                "start": start.strftime(time_format),
-                "end": end.strftime(time_format),
-                "step": int(step),
-                "bins": 0,
-                "series": {}
-            }
-            resp.body = json.dumps(data)
-            return
-        steps_until_first = int((first - start).total_seconds() // dt.total_seconds())
-        start = start + steps_until_first * dt
-        i = 0
-        series = Counter()
+        steps = parse_steps(req)
         skip_spam = not want_spam(req)
-        for t in tw:
-            if skip_spam and is_spam(t):
-                continue
-            while not t["datetime"] < start + (i + 1) * dt:
-                i += 1
-            series[i] += 1
-        last = max(series.keys())
+        series = {}
+        # the steps of whole hours are counted once, in bins of their greatest common divisor
+        for (base, base_steps) in step_bases(steps):
+            counts = Counter()
+            spam_counts = Counter()
+            for (_, i, n, spam) in count_series([keyword], start, end, base):
+                counts[i] += n
+                spam_counts[i] += spam
+            for dt in base_steps:
+                series[dt] = time_series(counts, spam_counts, start, end, base, dt, skip_spam)
+        data = [series[dt] for dt in steps]
+        send(req, resp, data[0] if len(steps) == 1 else data)
+
+def time_series(counts, spam_counts, start, end, base, dt, skip_spam):
+    """The time series object in bins of dt, from the counts in bins of base
+    (which divides dt)."""
+    ratio = dt // base
+    # bins counts the tweets in each bin, where bin 0 starts at start
+    # first is the bin of the first tweet, including spam
+    bins = Counter()
+    first = None
+    for (i, n) in counts.items():
+        if n <= 0:
+            continue
+        j = i // ratio
+        first = j if first is None else min(first, j)
+        count = n - spam_counts[i] if skip_spam else n
+        if count > 0:
+            bins[j] += count
+    step = int(dt.total_seconds())
+    if not bins:
+        # empty time series
+        return {
+            "start": start.strftime(time_format),
+            "end": end.strftime(time_format),
+            "step": step,
+            "bins": 0,
+            "series": {}
+        }
+    start = start + first * dt
+    series = {str(i - first): c for (i, c) in bins.items()}
+    last = max(bins.keys()) - first
+    return {
+        "start": start.strftime(time_format),
+        "end": (start + (last + 1) * dt).strftime(time_format),
+        "step": step,
+        "bins": len(series),
+        "series": series
+    }
+
+class KeywordsSeriesResource:
+    @falcon.before(get_dates)
+    def on_get(self, req, resp, start, end):
+        """Time series of many keywords at once, counted in one pass over the
+        tweets. Takes the keywords as a comma separated `keywords` GET parameter,
+        or all keywords of the `group`. Step is mandatory as for
+        /keywords/{keyword}/series.
+
+        Returns an object where:
+            - start and end are the requested range, the last bin can end after end
+            - step is the requested time bin size
+            - bins is the number of bins
+            - keywords is the list of keywords
+            - series is a list with for every keyword a list of the counts in all bins
+        """
+        dt = parse_step(req)
+        kws = req.get_param_as_list("keywords")
+        group = req.get_param("group")
+        if kws:
+            kws = list(OrderedDict.fromkeys(kws))
+        elif group:
+            kws = sorted(registry.groups.get(group, []))
+        else:
+            raise falcon.HTTPBadRequest("Bad request", "Give the keywords or a group.")
+        num_bins = max(0, -((start - end) // dt))
+        index = {kw: i for (i, kw) in enumerate(kws)}
+        series = [[0] * num_bins for _ in kws]
+        skip_spam = not want_spam(req)
+        for (kw, i, n, spam) in count_series(kws, start, end, dt):
+            series[index[kw]][i] += n - spam if skip_spam else n
         data = {
             "start": start.strftime(time_format),
-            "end": (start + (last + 1) * dt).strftime(time_format),
-            "step": int(step),
-            "bins": len(series),
+            "end": end.strftime(time_format),
+            "step": int(dt.total_seconds()),
+            "bins": num_bins,
+            "keywords": kws,
             "series": series
         }
-        resp.body = json.dumps(data)
+        send(req, resp, data)
+
+def count_series(keywords, start, end, dt):
+    """Yields (keyword, bin, tweets, spam) for the keywords from start to end,
+    where bin 0 starts at start. Whole hours come from the rollups when the
+    bins are whole hours, the rest is counted in the archive and MongoDB."""
+    step_ms = int(dt.total_seconds() * 1000)
+    raw_start = start
+    if dt % timedelta(hours=1) == timedelta(0) and start == floor_hour(start):
+        raw_start = max(start, floor_hour(end))
+        yield from read_bins(rollups, keywords, start, raw_start, step_ms)
+    archive_end = archive.archived_until(db)
+    if raw_start < archive_end:
+        yield from archive.count_bins(keywords, raw_start, min(end, archive_end), start, step_ms)
+        raw_start = archive_end
+    if raw_start >= end:
+        return
+    pipeline = [
+        {"$match": {"keywords": {"$in": keywords}, "datetime": {"$gte": raw_start, "$lt": end}}},
+        {"$project": {"keywords": True, "datetime": True, "spam": True, "_id": False}},
+        {"$unwind": "$keywords"},
+        {"$match": {"keywords": {"$in": keywords}}},
+        {"$group": {
+            "_id": {"keyword": "$keywords", "bin": bin_expr("$datetime", start, step_ms)},
+            "tweets": {"$sum": 1},
+            "spam": {"$sum": {"$cond": [{"$gt": ["$spam", spam_level]}, 1, 0]}},
+        }},
+    ]
+    for r in partitions.aggregate(db, pipeline):
+        yield r["_id"]["keyword"], int(r["_id"]["bin"]), r["tweets"], r["spam"]
+
+# the fields of a tweet document that are counted in the rollups and the statistics
+rollup_projection = {"keywords": True, "num_keywords": True, "groups": True, "datetime": True, "spam": True}
 
 class TweetResource:
     def on_get(self, req, resp, id_str):
+        tweets = partitions.collection_for_id(db, id_str)
         t = tweets.find_one({"tweet.id_str": id_str}, projection={"datetime": False, "_id": False})
         if t:
-            resp.body = json.dumps(t)
+            send(req, resp, t)
         else:
             raise falcon.HTTPNotFound()
 
     def on_delete(self, req, resp, id_str):
-        t = tweets.delete_one({"tweet.id_str": id_str})
-        if t.deleted_count > 0:
+        tweets = partitions.collection_for_id(db, id_str)
+        t = tweets.find_one_and_delete({"tweet.id_str": id_str}, projection=rollup_projection)
+        if t:
+            update_rollups(rollups, [t], sign=-1)
+            count_tweets(redis, [t], sign=-1)
+            api_cache.invalidate(t["keywords"], t["groups"])
             resp.status = falcon.HTTP_204
         else:
             raise falcon.HTTPNotFound()
@@ -313,12 +605,16 @@ class TweetResource:
         except ValueError as e:
             msg = "Invalid JSON: " + str(e)
             raise falcon.HTTPBadRequest("Bad request", msg)
-        t = tweets.find_one({"tweet.id_str": id_str}, projection={"_id": True})
+        tweets = partitions.collection_for_id(db, id_str)
+        t = tweets.find_one({"tweet.id_str": id_str}, projection=rollup_projection)
         if not t:
             raise falcon.HTTPNotFound()
         update = json_merge_patch_to_mongo_update(patch)
         try:
             tweets.update_one({"_id": t["_id"]}, update)
+            if "spam" in patch:
+                update_rollups_spam(rollups, [(t, t.get("spam"), patch["spam"])])
+            api_cache.invalidate(t["keywords"], t["groups"])
             resp.status = falcon.HTTP_204
         except Exception as e:
             msg = ("Error: {}. ".format(str(e)) +
@@ -342,6 +638,136 @@ def json_merge_patch_to_mongo_update(patch):
     return update
 
 
+class CacheMiddleware:
+    """Caches responses on /keywords and /series for ranges that ended more
+    than an hour ago: these don't change anymore, except when tweets are
+    changed, deleted or inserted late and when the keywords of the groups
+    change, which invalidates them. The responses have a weak ETag, as they're
+    compressed after they're cached: requests with a matching If-None-Match get
+    a 304 Not Modified.
+    """
+    max_size = 16 * 1024 * 1024  # don't cache larger (streamed) responses
+
+    def process_request(self, req, resp):
+        if req.method != "GET" or not (req.path.startswith("/keywords") or req.path == "/series"):
+            return
+        try:
+            start, end = parse_dates(req)
+            steps = parse_steps(req) if req.get_param("step") else []
+        except falcon.HTTPBadRequest:
+            return
+        if end > datetime.utcnow() - api_cache.FINAL_AGE:
+            return
+        # the key has the dates and steps the resources see: missing dates default to today
+        params = {k: v for (k, v) in req.params.items() if k != "token"}
+        params["start"], params["end"] = start.strftime(time_format), end.strftime(time_format)
+        params["step"] = ",".join(str(int(dt.total_seconds())) for dt in steps)
+        params["spam"] = "1" if want_spam(req) else "0"
+        if req.get_param("group"):
+            # the keywords of the group at the version of the registry this process has
+            params["registry"] = registry.version
+        params["accept"] = req.client_prefers([falcon.MEDIA_JSON, NDJSON, MSGPACK, MSGPACK_STREAM]) or ""
+        key = api_cache.make_key(req.path, params)
+        etag = api_cache.get_etag(key)
+        if etag is not None:
+            if api_cache.etag_matches(req.get_header("If-None-Match"), etag):
+                resp.status = falcon.HTTP_304
+                resp.set_header("ETag", etag)
+                resp.complete = True
+                return
+            entry = api_cache.get(key, etag)
+            if entry is not None:
+                resp.content_type = entry["content_type"]
+                resp.data = entry["body"]
+                resp.set_header("ETag", etag)
+                if entry["next"]:
+                    resp.set_header("X-Next-Cursor", entry["next"])
+                resp.complete = True
+                return
+        req.context["cache_key"] = key
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        key = req.context.get("cache_key")
+        if not key or not req_succeeded or resp.status != falcon.HTTP_200:
+            return
+        if resp.stream is not None:
+            stream = iter(resp.stream)
+            chunks = []
+            size = 0
+            for chunk in stream:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > self.max_size:
+                    resp.stream = chain(chunks, stream)
+                    return
+            body = b"".join(chunks)
+            resp.stream = None
+        else:
+            body = resp.data if resp.body is None else resp.body.encode("utf-8")
+            resp.body = None
+        resp.data = body
+        etag = api_cache.make_etag(body)
+        resp.set_header("ETag", etag)
+
+        segments = req.path.strip("/").split("/")
+        if segments == ["series"]:
+            tags = [api_cache.keyword_tag(kw) for kw in req.get_param_as_list("keywords") or []]
+            tags.append(api_cache.group_tag(req.get_param("group")))
+        elif len(segments) > 1:
+            tags = [api_cache.keyword_tag(segments[1])]
+        else:
+            tags = [api_cache.group_tag(req.get_param("group"))]
+        entry = {
+            "etag": etag,
+            "content_type": resp.content_type,
+            "body": body,
+            "next": resp.get_header("X-Next-Cursor") or "",
+        }
+        api_cache.put(key, tags, entry)
+
+class CompressionMiddleware:
+    """Compresses responses with zstd or gzip, whichever the client accepts
+    (preferring zstd)."""
+    min_size = 1024
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        # also uncompressed responses (and 304s) depend on the header
+        resp.append_header("Vary", "Accept-Encoding")
+        encodings = [e.split(";")[0].strip() for e in (req.get_header("Accept-Encoding") or "").split(",")]
+        if zstandard and "zstd" in encodings:
+            encoding = "zstd"
+        elif "gzip" in encodings:
+            encoding = "gzip"
+        else:
+            return
+        if resp.stream is not None:
+            resp.stream = compress_chunks(resp.stream, encoding)
+        else:
+            data = resp.data if resp.body is None else resp.body.encode("utf-8")
+            if data is None or len(data) < self.min_size:
+                return
+            resp.body = None
+            resp.data = b"".join(compress_chunks([data], encoding))
+        resp.set_header("Content-Encoding", encoding)
+
+def compress_chunks(chunks, encoding):
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class MetricsResource:
+    def on_get(self, req, resp):
+        """The ingest metrics in the Prometheus text format."""
+        resp.content_type = "text/plain; version=0.0.4"
+        resp.body = metrics.render(redis)
+
 class AuthenticationMiddleware:
     def process_request(self, req, resp):
         token = req.get_param("token")
@@ -353,6 +779,7 @@ class AuthenticationMiddleware:
             # users may not access:
             if (p.startswith("/keywords/") and (p.endswith("/texts") or p.count("/") == 2) or  # /keywords/{keyword}, /keywords/{keyword}/texts
                 p.startswith("/tweet/") or  # /tweet/{id_str}
+                p == "/metrics" or
                 p.startswith("/groups/") and m in ["DELETE", "PUT"] or  # PUT/DELETE on /groups/{group}
                 p.startswith("/groups") and m == "POST"):   # POST on /groups
                 raise falcon.HTTPForbidden()
@@ -360,10 +787,13 @@ class AuthenticationMiddleware:
             raise falcon.HTTPForbidden()
 
 
-app = application = falcon.API(middleware=AuthenticationMiddleware())
+# process_response runs in reverse order: responses are cached before they're compressed
+app = application = falcon.API(middleware=[AuthenticationMiddleware(), CompressionMiddleware(), CacheMiddleware()])
 app.add_route("/keywords", KeywordsResource())
+app.add_route("/series", KeywordsSeriesResource())
 app.add_route("/groups", GroupsResource())
 app.add_route("/groups/{group}", GroupResource())
+app.add_route("/registry", RegistryResource())
 app.add_route("/keywords/{keyword}", KeywordResource())
 app.add_route("/keywords/{keyword}/ids", KeywordIdsResource())
 app.add_route("/keywords/{keyword}/media", KeywordMediaResource())
@@ -373,3 +803,4 @@ app.add_route("/keywords/{keyword}/users", KeywordUsersResource())
 app.add_route("/keywords/{keyword}/wordcloud", KeywordWordcloudResource())
 app.add_route("/keywords/{keyword}/series", KeywordTimeSeriesResource())
 app.add_route("/tweet/{id_str}", TweetResource())
+app.add_route("/metrics", MetricsResource())
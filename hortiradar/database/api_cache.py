@@ -0,0 +1,143 @@
+"""Cache of API responses that don't change anymore, in redis with an
+in-process LRU in front of it.
+
+An entry is a redis hash with the ETag, content type, body and the cursor of
+the next page. The LRU only holds bodies, it checks the ETag in redis so entries
+invalidated by other processes are never served. Entries are tagged with the
+keywords and groups they count, so changes to tweets can invalidate them.
+"""
+from collections import OrderedDict
+from datetime import timedelta
+from hashlib import sha1
+
+from redis import StrictRedis
+
+
+redis = StrictRedis()
+
+CACHE_TIME = 60 * 60 * 24
+# responses for ranges that ended longer ago than this are cached, tweets
+# inserted later than this after they were sent must invalidate them
+FINAL_AGE = timedelta(hours=1)
+LRU_SIZE = 64 * 1024 * 1024  # bytes
+
+
+class LRU:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.pop(key)
+        body = entry["body"]
+        if len(body) > self.max_size:
+            return
+        self.entries[key] = entry
+        self.size += len(body)
+        while self.size > self.max_size:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old["body"])
+
+    def pop(self, key):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old["body"])
+
+
+lru = LRU(LRU_SIZE)
+
+
+def make_key(path, params):
+    """The cache key of the normalized request."""
+    normalized = path + "?" + "&".join("{}={}".format(k, v) for (k, v) in sorted(params.items()))
+    return "api:cache:" + sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def make_etag(body):
+    """A weak ETag: the same body is sent with different content codings."""
+    return 'W/"{}"'.format(sha1(body).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of the ETag with those in an If-None-Match header."""
+    if not if_none_match:
+        return False
+    tags = {t.strip() for t in if_none_match.split(",")}
+    return "*" in tags or etag.replace("W/", "", 1) in {t.replace("W/", "", 1) for t in tags}
+
+
+def get_etag(key):
+    etag = redis.hget(key, "etag")
+    return etag.decode("ascii") if etag else None
+
+
+def get(key, etag):
+    """Returns the entry with the ETag (from get_etag)."""
+    entry = lru.get(key)
+    if entry is not None and entry["etag"] == etag:
+        return entry
+    data = redis.hgetall(key)
+    if not data or data[b"etag"].decode("ascii") != etag:
+        return None
+    entry = {
+        "etag": etag,
+        "content_type": data[b"content_type"].decode("utf-8"),
+        "body": data[b"body"],
+        "next": data[b"next"].decode("ascii"),
+    }
+    lru.put(key, entry)
+    return entry
+
+
+def put(key, tags, entry):
+    pipe = redis.pipeline()
+    pipe.hmset(key, entry)
+    pipe.expire(key, CACHE_TIME)
+    for tag in tags:
+        pipe.sadd("api:tag:" + tag, key)
+        pipe.expire("api:tag:" + tag, CACHE_TIME)
+    pipe.execute()
+    lru.put(key, entry)
+
+
+def keyword_tag(keyword):
+    return "keyword:" + keyword
+
+
+def group_tag(group):
+    return "group:" + (group or "")
+
+
+def invalidate(keywords, groups):
+    """Drop the cached responses about the keywords and groups. The responses
+    about all keywords are in the group "" (no group)."""
+    tags = ["api:tag:" + keyword_tag(kw) for kw in keywords]
+    tags += ["api:tag:" + group_tag(g) for g in list(groups) + [None]]
+    drop(tags)
+
+
+def invalidate_groups():
+    """Drop the cached responses about groups, for when the keywords of the
+    groups changed."""
+    drop(list(redis.scan_iter("api:tag:" + group_tag("?*"))))
+
+
+def drop(tags):
+    """Drop the cached responses with the tags."""
+    if not tags:
+        return
+    keys = set()
+    for tag in tags:
+        keys.update(redis.smembers(tag))
+    if keys:
+        redis.delete(*keys)
+    redis.delete(*tags)
+    for key in keys:
+        lru.pop(key.decode("ascii"))
@@ -0,0 +1,218 @@
+"""Archive of the tweets with keywords of closed months, in compressed columnar
+numpy files instead of MongoDB.
+
+Every month is one file `tweets_YYYYMM.npz` in the archive directory with a
+column per field, one row per tweet:
+
+    datetime      seconds since the epoch (int64)
+    user          user id (int64)
+    spam          spam score, NaN for none (float32)
+    keywords      the keyword lemmas (the dictionary of the keyword ids)
+    kw_offsets    the keyword ids of tweet i are kw_ids[kw_offsets[i]:kw_offsets[i+1]]
+    kw_ids
+    lemmas        the token lemmas (the dictionary of the token ids)
+    tok_offsets   the token ids of tweet i are tok_ids[tok_offsets[i]:tok_offsets[i+1]]
+    tok_ids
+
+The archived months are in the `archive` collection, the tweets of those months
+are removed from MongoDB. The rollups stay. The API reads the time series, users
+and wordcloud of a keyword from the archive for ranges before the end of the
+archive, and the counts of the keywords in the hours that the rollups don't
+cover. Archive the months older than `archive_months` with:
+
+    python archive.py
+"""
+import argparse
+import os
+from collections import Counter
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+from functools import lru_cache
+from os.path import dirname, join
+
+import numpy as np
+
+from hortiradar.database import get_db
+from hortiradar.database.partitions import (collection_for, collections, find, month_start, next_month,
+                                            partition_month, partition_name, partitioned)
+
+
+config = ConfigParser()
+config.read(dirname(__file__) + "/../clustering/config.ini")
+spam_level = config.getfloat("database:parameters", "spam_level")
+archive_dir = join(dirname(__file__), config.get("database:parameters", "archive_dir", fallback="archive"))
+archive_months = config.getint("database:parameters", "archive_months", fallback=15)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_seconds(dt):
+    return int((dt - EPOCH).total_seconds())
+
+
+def month_file(month):
+    return join(archive_dir, partition_name(month) + ".npz")
+
+
+def archived_until(db):
+    """The end of the archive: the tweets before it are in the archive."""
+    last = db.archive.find_one(sort=[("month", -1)])
+    return next_month(last["month"]) if last else datetime.min
+
+
+def columns(tweets):
+    """The columns of the tweet documents."""
+    dts, users, spams = [], [], []
+    kw_ids, kw_offsets = [], [0]
+    tok_ids, tok_offsets = [], [0]
+    keywords = {}
+    lemmas = {}
+    for t in tweets:
+        dts.append(to_seconds(t["datetime"]))
+        users.append(int(t["tweet"]["user"]["id_str"]))
+        spams.append(np.nan if t.get("spam") is None else t["spam"])
+        kw_ids += [keywords.setdefault(kw, len(keywords)) for kw in t["keywords"]]
+        kw_offsets.append(len(kw_ids))
+        tok_ids += [lemmas.setdefault(tok["lemma"], len(lemmas)) for tok in t["tokens"]]
+        tok_offsets.append(len(tok_ids))
+    return {
+        "datetime": np.array(dts, dtype=np.int64),
+        "user": np.array(users, dtype=np.int64),
+        "spam": np.array(spams, dtype=np.float32),
+        "keywords": np.array(list(keywords), dtype=np.str_),
+        "kw_offsets": np.array(kw_offsets, dtype=np.int64),
+        "kw_ids": np.array(kw_ids, dtype=np.int32),
+        "lemmas": np.array(list(lemmas), dtype=np.str_),
+        "tok_offsets": np.array(tok_offsets, dtype=np.int64),
+        "tok_ids": np.array(tok_ids, dtype=np.int32),
+    }
+
+
+def archive_month(db, month):
+    """Write the tweets with keywords of the month to the archive and remove
+    the month from MongoDB."""
+    start, end = month_start(month), next_month(month)
+    tweets = find(db, {"num_keywords": {"$gt": 0}, "datetime": {"$gte": start, "$lt": end}}, projection={
+        "datetime": True, "tweet.user.id_str": True, "spam": True, "keywords": True, "tokens.lemma": True,
+        "_id": False,
+    })
+    data = columns(tweets)
+    os.makedirs(archive_dir, exist_ok=True)
+    tmp = month_file(start) + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **data)
+    os.replace(tmp, month_file(start))
+    db.archive.insert_one({"month": start, "tweets": len(data["datetime"])})
+    if partitioned:
+        collection_for(db, start).drop()
+    else:
+        db.tweets.delete_many({"datetime": {"$gte": start, "$lt": end}})
+
+
+@lru_cache(maxsize=4)
+def load_month(month):
+    """The columns of the archived month, with the rows of the keyword and token ids."""
+    with np.load(month_file(month)) as f:
+        data = {k: f[k] for k in f.files}
+    rows = np.arange(len(data["datetime"]))
+    data["kw_rows"] = np.repeat(rows, np.diff(data["kw_offsets"]))
+    data["tok_rows"] = np.repeat(rows, np.diff(data["tok_offsets"]))
+    return data
+
+
+def months(start, end):
+    """The archived months from start to end."""
+    if not os.path.isdir(archive_dir):
+        return []
+    archived = sorted(partition_month(f[:-len(".npz")]) for f in os.listdir(archive_dir) if f.endswith(".npz"))
+    return [m for m in archived if next_month(m) > start and m < end]
+
+
+def select(data, keyword, start, end, skip_spam):
+    """The rows of the tweets with the keyword from start to end."""
+    kw = np.flatnonzero(data["keywords"] == keyword)
+    if len(kw) == 0:
+        return np.array([], dtype=np.int64)
+    rows = data["kw_rows"][data["kw_ids"] == kw[0]]
+    dts = data["datetime"][rows]
+    mask = (dts >= to_seconds(start)) & (dts < to_seconds(end))
+    if skip_spam:
+        mask &= ~(data["spam"][rows] > spam_level)
+    return rows[mask]
+
+
+def count_users(keyword, start, end, skip_spam):
+    """Number of tweets per user id_str."""
+    counts = Counter()
+    for month in months(start, end):
+        data = load_month(month)
+        users, n = np.unique(data["user"][select(data, keyword, start, end, skip_spam)], return_counts=True)
+        counts.update({str(u): int(c) for (u, c) in zip(users, n)})
+    return counts
+
+
+def count_lemmas(keyword, start, end, skip_spam):
+    """Number of tokens per lemma."""
+    counts = Counter()
+    for month in months(start, end):
+        data = load_month(month)
+        rows = select(data, keyword, start, end, skip_spam)
+        ids = data["tok_ids"][np.isin(data["tok_rows"], rows)]
+        lemmas, n = np.unique(ids, return_counts=True)
+        counts.update({str(data["lemmas"][l]): int(c) for (l, c) in zip(lemmas, n)})
+    return counts
+
+
+def count_keywords(start, end, keywords=None):
+    """Number of tweets per keyword from start to end, of all keywords or only
+    of the set `keywords`."""
+    counts = Counter()
+    for month in months(start, end):
+        data = load_month(month)
+        dts = data["datetime"][data["kw_rows"]]
+        mask = (dts >= to_seconds(start)) & (dts < to_seconds(end))
+        ids, n = np.unique(data["kw_ids"][mask], return_counts=True)
+        for (i, c) in zip(ids, n):
+            keyword = str(data["keywords"][i])
+            if keywords is None or keyword in keywords:
+                counts[keyword] += int(c)
+    return counts
+
+
+def count_bins(keywords, start, end, origin, step_ms):
+    """Yields (keyword, bin, tweets, spam) for the tweets with the keywords from
+    start to end, in bins of step_ms where bin 0 starts at origin."""
+    for month in months(start, end):
+        data = load_month(month)
+        for keyword in keywords:
+            rows = select(data, keyword, start, end, skip_spam=False)
+            if len(rows) == 0:
+                continue
+            bins = (data["datetime"][rows] - to_seconds(origin)) * 1000 // step_ms
+            spam = data["spam"][rows] > spam_level
+            uniq, inverse, n = np.unique(bins, return_inverse=True, return_counts=True)
+            spam_n = np.bincount(inverse, weights=spam, minlength=len(uniq))
+            for (b, c, sc) in zip(uniq, n, spam_n):
+                yield keyword, int(b), int(c), int(sc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive the tweets of closed months.")
+    parser.add_argument("--months", type=int, default=archive_months, help="archive the months older than this")
+    args = parser.parse_args()
+
+    db = get_db()
+    limit = month_start(datetime.utcnow() - timedelta(days=31 * args.months))
+    tweets = collections(db)
+    first = tweets[0].find_one(sort=[("_id", 1)], projection={"datetime": True}) if tweets else None
+    if first is None:
+        return
+    month = max(month_start(first["datetime"]), archived_until(db))
+    while month < limit:
+        print(partition_name(month))
+        archive_month(db, month)
+        month = next_month(month)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Benchmark of the response formats of the API on a keyword-week payload: the
+size in bytes and the time to decode (decompress and parse) it on the client.
+
+    python bench_formats.py tulp
+"""
+import argparse
+import gzip
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import msgpack
+import ujson as json
+import zstandard
+
+import partitions
+from api import KEYWORD_FIELDS, db, fields_projection, not_spam
+
+
+def load_payload(keyword, start, end):
+    """The response of /keywords/{keyword} with all fields."""
+    projection = fields_projection(list(KEYWORD_FIELDS))
+    query = {"keywords": keyword, "datetime": {"$gte": start, "$lt": end}, "spam": not_spam}
+    return list(partitions.find(db, query, projection=projection))
+
+
+def timed(f, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = perf_counter()
+        f()
+        best = min(best, perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JSON and MessagePack with compression.")
+    parser.add_argument("keyword")
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    end = datetime.utcnow()
+    start = end - timedelta(days=args.days)
+    payload = load_payload(args.keyword, start, end)
+    print("{} tweets for {} in the last {} days\n".format(len(payload), args.keyword, args.days))
+
+    formats = {
+        "json": (json.dumps(payload).encode("utf-8"), json.loads),
+        "msgpack": (msgpack.packb(payload, use_bin_type=True), lambda b: msgpack.unpackb(b, raw=False)),
+    }
+    encodings = {
+        "identity": (lambda b: b, lambda b: b),
+        "gzip": (lambda b: gzip.compress(b, 6), gzip.decompress),
+        "zstd": (zstandard.ZstdCompressor().compress, lambda b: zstandard.ZstdDecompressor().decompress(b)),
+    }
+    print("{:<10} {:<10} {:>12} {:>12}".format("format", "encoding", "bytes", "decode (ms)"))
+    for (name, (data, loads)) in formats.items():
+        for (encoding, (compress, decompress)) in encodings.items():
+            compressed = compress(data)
+            seconds = timed(lambda: loads(decompress(compressed)))
+            print("{:<10} {:<10} {:>12,} {:>12.1f}".format(name, encoding, len(compressed), seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
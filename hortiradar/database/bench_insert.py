@@ -0,0 +1,117 @@
+"""Benchmark of the master's tweet inserts: the insert_tweet task from before
+the batches, one tweet at a time, against the batches of insert_tweets.
+
+Uses the `twitter_benchmark` database and redis database 15, both are emptied.
+
+    python bench_insert.py --tweets 10000 --batch-size 100
+"""
+import argparse
+from datetime import datetime, timedelta
+from random import choice, randrange
+from time import perf_counter
+
+import pymongo
+import ujson as json
+from redis import StrictRedis
+
+import tasks_master
+
+
+WORDS = ["de", "tulp", "is", "mooi", "en", "een", "roos", "ook", "vandaag", "appels", "!", "#bloemen"]
+
+
+def fake_tweet(i, now):
+    created_at = now - timedelta(seconds=randrange(3600))
+    text = " ".join(choice(WORDS) for _ in range(20))
+    j = {
+        "id_str": str(10**18 + i),
+        "created_at": created_at.strftime(tasks_master.tweet_time_format),
+        "text": text,
+        "user": {"id_str": str(randrange(10**6)), "screen_name": "user"},
+        "entities": {"hashtags": [], "urls": [], "user_mentions": []},
+    }
+    tokens = [
+        {"index": str(n), "text": w, "lemma": w, "pos": "N(soort,ev,basis,zijd,stan)", "posprob": 0.9}
+        for (n, w) in enumerate(text.split(), 1)
+    ]
+    keywords = ["tulp"] if "tulp" in text else []
+    groups = ["bloemen"] if keywords else []
+    return j, (j["id_str"], keywords, groups, tokens)
+
+
+def stage(redis, tweets):
+    redis.flushdb()
+    pipe = redis.pipeline()
+    for (j, _) in tweets:
+        pipe.set("t:" + j["id_str"], json.dumps(j))
+    pipe.execute()
+
+
+def insert_tweet(id_str, keywords, groups, tokens):
+    """The insert_tweet task of the master before the batches."""
+    redis, db = tasks_master.redis, tasks_master.db
+    key = "t:" + id_str
+    data = redis.get(key)
+    if data is None:
+        # the tweet was already inserted
+        return
+    j = json.loads(data)
+    tweet = {
+        "tweet": j,
+        "keywords": keywords,
+        "num_keywords": len(keywords),
+        "groups": groups,
+        "tokens": tokens,
+        "datetime": datetime.strptime(j["created_at"], tasks_master.tweet_time_format),
+    }
+    spam = j.get("possibly_sensitive", False)
+    if spam:
+        tweet["spam"] = 0.7
+    db.tweets.insert_one(tweet)
+    redis.delete(key)
+
+
+def run(tweets, batch_size):
+    """Insert the staged tweets, per tweet with the old task when batch_size is None."""
+    items = [item for (_, item) in tweets]
+    t0 = perf_counter()
+    if batch_size is None:
+        for item in items:
+            insert_tweet(*item)
+    else:
+        for i in range(0, len(items), batch_size):
+            tasks_master.insert_tweets(items[i:i + batch_size])
+    return perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched tweet inserts.")
+    parser.add_argument("--tweets", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=tasks_master.batch_size)
+    args = parser.parse_args()
+
+    mongo = pymongo.MongoClient()
+    db = mongo.twitter_benchmark
+    redis = StrictRedis(db=15)
+    tasks_master.db = db
+    tasks_master.redis = redis
+
+    now = datetime.utcnow()
+    tweets = [fake_tweet(i, now) for i in range(args.tweets)]
+
+    for (name, batch_size) in [("per tweet", None), ("batched", args.batch_size)]:
+        mongo.drop_database("twitter_benchmark")
+        stage(redis, tweets)
+        seconds = run(tweets, batch_size)
+        assert db.tweets.count_documents({}) == len(tweets)
+        # inserting again is a no-op, the tweets were already inserted
+        run(tweets, batch_size)
+        assert db.tweets.count_documents({}) == len(tweets)
+        print("{:>10}: {:8.0f} tweets/s ({:.2f} s)".format(name, len(tweets) / seconds, seconds))
+
+    mongo.drop_database("twitter_benchmark")
+    redis.flushdb()
+
+
+if __name__ == "__main__":
+    main()
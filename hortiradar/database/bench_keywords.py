@@ -0,0 +1,88 @@
+"""Benchmark of counting the keywords of a group for /keywords: the Python loop
+over all tweets in the group the API used to do, against the aggregation
+pipeline in MongoDB.
+
+Uses a synthetic collection in the `twitter_benchmark` database, which is
+dropped afterwards.
+
+    python bench_keywords.py --tweets 200000
+"""
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+from random import randrange, sample
+from time import perf_counter
+
+import pymongo
+
+import api
+from keywords import Keyword, make_snapshot
+
+
+def make_keywords(n):
+    keywords = {}
+    for i in range(n):
+        groups = ["bloemen"] if i % 2 else ["groente_en_fruit"]
+        if i % 10 == 0:
+            groups.append("planten")
+        keywords["kw%d" % i] = Keyword(lemma="kw%d" % i, pos="N", groups=groups)
+    return keywords
+
+
+def make_tweets(tweets, keywords, n, start):
+    lemmas = list(keywords)
+    batch = []
+    for i in range(n):
+        kws = sample(lemmas, randrange(1, 4))
+        groups = sorted({g for kw in kws for g in keywords[kw].groups})
+        batch.append({
+            "keywords": kws, "num_keywords": len(kws), "groups": groups,
+            "datetime": start + timedelta(seconds=randrange(7 * 24 * 60 * 60)),
+        })
+        if len(batch) == 10000:
+            tweets.insert_many(batch)
+            batch = []
+    if batch:
+        tweets.insert_many(batch)
+    tweets.create_index([("groups", 1), ("datetime", 1)])
+
+
+def count_loop(tweets, keywords, start, end, group):
+    """The old /keywords implementation."""
+    query = {"groups": group, "datetime": {"$gte": start, "$lt": end}}
+    counts = Counter()
+    for t in tweets.find(query, projection={"keywords": True, "_id": False}):
+        counts.update(kw for kw in t["keywords"] if kw in keywords and group in keywords[kw].groups)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark counting the keywords of a group.")
+    parser.add_argument("--tweets", type=int, default=200000)
+    parser.add_argument("--keywords", type=int, default=500)
+    args = parser.parse_args()
+
+    mongo = pymongo.MongoClient()
+    mongo.drop_database("twitter_benchmark")
+    tweets = mongo.twitter_benchmark.tweets
+    keywords = make_keywords(args.keywords)
+    start = datetime(2018, 1, 1)
+    end = start + timedelta(days=7)
+    make_tweets(tweets, keywords, args.tweets, start)
+
+    api.db = mongo.twitter_benchmark
+    api.registry = make_snapshot(0, keywords)
+    for group in ["bloemen", "planten"]:
+        t0 = perf_counter()
+        loop = count_loop(tweets, keywords, start, end, group)
+        t1 = perf_counter()
+        pipeline = api.count_keywords(start, end, group)
+        t2 = perf_counter()
+        assert loop == pipeline
+        print("{:<10} loop: {:6.2f} s   pipeline: {:6.2f} s".format(group, t1 - t0, t2 - t1))
+
+    mongo.drop_database("twitter_benchmark")
+
+
+if __name__ == "__main__":
+    main()
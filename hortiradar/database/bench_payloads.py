@@ -0,0 +1,102 @@
+"""Benchmark of the messages from the workers to the master with JSON and the
+compact hortiradar-msgpack serializer, on the latest tweets in the database:
+the bytes per tweet and the time to encode and decode the messages, for
+messages of one tweet (insert_tweet) and of a batch (insert_tweet_batch).
+
+With `--broker` the messages also go through RabbitMQ, to the temporary queue
+`bench_payloads`.
+
+    python bench_payloads.py --tweets 2000 --batch-size 20 --broker
+"""
+import argparse
+from time import perf_counter, time
+
+from kombu.serialization import dumps, loads
+
+import partitions
+import payloads
+from hortiradar.database import app, get_db
+
+
+SERIALIZERS = ["json", payloads.NAME]
+EMBED = {"callbacks": None, "errbacks": None, "chain": None, "chord": None}
+
+
+def load_items(n):
+    """The (id_str, keywords, groups, tokens) of the latest n tweets."""
+    db = get_db()
+    items = []
+    for collection in reversed(partitions.collections(db)):
+        cursor = collection.find({}, projection={"tweet.id_str": True, "keywords": True, "groups": True,
+                                                 "tokens": True, "_id": False})
+        for t in cursor.sort("_id", -1).limit(n - len(items)):
+            items.append((t["tweet"]["id_str"], t["keywords"], t["groups"], t["tokens"]))
+        if len(items) == n:
+            break
+    return items
+
+
+def message_bodies(items, batch_size):
+    """The bodies of the Celery messages for the items, with the task stamps."""
+    stamps = {"worker_start": time(), "worker_done": time(), "frog_cache": {"miss": 1}}
+    if batch_size == 1:
+        return [(item, dict(stamps=dict(stamps, received=[time()])), EMBED) for item in items]
+    return [((items[i:i + batch_size],), dict(stamps=dict(stamps, received=[time()] * batch_size)), EMBED)
+            for i in range(0, len(items), batch_size)]
+
+
+def roundtrip(body, serializer):
+    content_type, encoding, data = dumps(body, serializer=serializer)
+    return loads(data, content_type, encoding)
+
+
+def timed(f, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = perf_counter()
+        f()
+        best = min(best, perf_counter() - t0)
+    return best
+
+
+def through_broker(bodies, serializer):
+    """Seconds to publish the bodies to RabbitMQ and consume them again."""
+    with app.connection_for_write() as conn:
+        queue = conn.SimpleQueue("bench_payloads", serializer=serializer)
+        queue.clear()
+        t0 = perf_counter()
+        for body in bodies:
+            queue.put(body)
+        for _ in bodies:
+            message = queue.get(timeout=10)
+            message.payload
+            message.ack()
+        seconds = perf_counter() - t0
+        queue.queue.delete()
+        queue.close()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the serializers of the messages to the master.")
+    parser.add_argument("--tweets", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--broker", action="store_true", help="also send the messages through RabbitMQ")
+    args = parser.parse_args()
+
+    items = load_items(args.tweets)
+    print("{} tweets\n".format(len(items)))
+    print("{:<8} {:<20} {:>12} {:>12} {:>12}".format("batch", "serializer", "bytes/tweet", "µs/tweet", "tweets/s"))
+    for batch_size in [1, args.batch_size]:
+        bodies = message_bodies(items, batch_size)
+        for serializer in SERIALIZERS:
+            assert all(roundtrip(body, serializer) == roundtrip(body, "json") for body in bodies)
+            size = sum(len(dumps(body, serializer=serializer)[2]) for body in bodies)
+            seconds = timed(lambda: [roundtrip(body, serializer) for body in bodies])
+            throughput = "{:12.0f}".format(len(items) / through_broker(bodies, serializer)) if args.broker else ""
+            print("{:<8} {:<20} {:>12.0f} {:>12.1f} {:>12}".format(
+                batch_size, serializer, size / len(items), seconds / len(items) * 1E6, throughput))
+
+
+if __name__ == "__main__":
+    main()
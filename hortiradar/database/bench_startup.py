@@ -0,0 +1,56 @@
+"""Benchmark of loading the keywords at startup: a request for the groups and
+one for every group with a new MongoDB client each (as get_keywords used to),
+against the single query of get_keywords.
+
+    python bench_startup.py [--remote]
+"""
+import argparse
+from time import perf_counter
+
+import pymongo
+import ujson as json
+
+from hortiradar import Tweety, TOKEN
+from keywords import Keyword, get_keywords
+
+
+def get_keywords_per_group(local):
+    """The old get_keywords."""
+    if local:
+        gs = pymongo.MongoClient().twitter.groups.find({}, projection={"name": True, "_id": False})
+        group_names = [g["name"] for g in gs]
+    else:
+        group_names = json.loads(Tweety("https://acba.labs.vu.nl/hortiradar/api/", TOKEN).get_groups())
+    keywords = {}
+    for name in group_names:
+        if local:
+            g = pymongo.MongoClient().twitter.groups.find_one({"name": name}).get("keywords", [])
+        else:
+            g = json.loads(Tweety("https://acba.labs.vu.nl/hortiradar/api/", TOKEN).get_group(name))
+        for keyword in g:
+            if keyword["lemma"] in keywords:
+                keywords[keyword["lemma"]].groups.append(name)
+            else:
+                keywords[keyword["lemma"]] = Keyword(lemma=keyword["lemma"], pos=keyword["pos"], groups=[name])
+    return keywords
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading the keywords.")
+    parser.add_argument("--remote", action="store_true", help="load the keywords through the API, as the workers do")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    local = not args.remote
+
+    for (name, load) in [("per group", get_keywords_per_group), ("one query", get_keywords)]:
+        best = float("inf")
+        for _ in range(args.repeat):
+            t0 = perf_counter()
+            keywords = load(local)
+            best = min(best, perf_counter() - t0)
+        print("{:>10}: {:8.1f} ms for {} keywords".format(name, best * 1000, len(keywords)))
+    assert get_keywords_per_group(local) == get_keywords(local)
+
+
+if __name__ == "__main__":
+    main()
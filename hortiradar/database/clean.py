@@ -1,14 +1,37 @@
+"""Deletes the tweets without keywords that are older than 15 months.
+
+With monthly partitions (see partitions.py) the partitions that are completely
+older than that are compacted once: their tweets with keywords are copied to a
+new collection that replaces the partition, so the untagged tweets go without
+deleting them one by one.
+"""
 from datetime import datetime, timedelta
 
 from keywords import get_db
+from partitions import create_tweets_indexes, next_month, partition_month, partition_names, partitioned
 
 
-tweets = get_db().tweets
+db = get_db()
 
 # tweet timestamps are in UTC time
 limit = datetime.utcnow() - timedelta(days=31 * 15)
 
-tweets.delete_many({
-    "num_keywords": 0,
-    "datetime": {"$lt": limit}
-})
+
+def compact(name):
+    tmp = name + "_compact"
+    db[name].aggregate([{"$match": {"num_keywords": {"$gt": 0}}}, {"$out": tmp}], allowDiskUse=True)
+    create_tweets_indexes(db[tmp])
+    db[tmp].rename(name, dropTarget=True)
+    db.partitions.update_one({"name": name}, {"$set": {"compacted": datetime.utcnow()}}, upsert=True)
+
+
+if partitioned:
+    compacted = {p["name"] for p in db.partitions.find({}, projection={"name": True})}
+    for name in partition_names(db):
+        if next_month(partition_month(name)) <= limit and name not in compacted:
+            compact(name)
+else:
+    db.tweets.delete_many({
+        "num_keywords": 0,
+        "datetime": {"$lt": limit}
+    })
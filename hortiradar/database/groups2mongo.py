@@ -2,7 +2,9 @@
 collection."""
 import argparse
 
-from keywords import get_db
+from redis import StrictRedis
+
+from keywords import announce_keywords, get_db
 
 
 GROUPS = {
@@ -36,3 +38,6 @@ for (group_name, filename) in groups:
     group = {"name": group_name, "keywords": keywords}
     db.groups.delete_many({"name": group_name})
     db.groups.insert_one(group)
+
+# the API processes and the workers reload the keywords
+announce_keywords(StrictRedis())
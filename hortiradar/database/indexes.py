@@ -1,13 +1,63 @@
+"""Make the indexes for the API. The index on the tweet ids is unique, the
+copies of tweets that were inserted twice before it was are removed first.
+tests/test_indexes.py checks that the queries of the keyword resources use them.
+
+    python indexes.py
+"""
+from redis import StrictRedis
+
 from keywords import get_db
+from partitions import collections, create_tweets_indexes
+from rollups import update_rollups
+from hortiradar.database.statistics import count_tweets
 
 db = get_db()
+redis = StrictRedis()
 
-tweets = db.tweets
 stories = db.stories
+rollups = db.rollups
+
+# indexes replaced by ones with more fields
+old_tweets_indexes = ["keywords_1_datetime_1", "keywords_1_datetime_1__id_1"]
+id_index = "tweet.id_str_1"
+
+
+def remove_duplicates(tweets):
+    """Delete the extra copies of the tweets that are in the collection more
+    than once, and take them out of the rollups and the statistics."""
+    groups = tweets.aggregate([
+        {"$group": {"_id": "$tweet.id_str", "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    copies = [_id for g in groups for _id in g["ids"][1:]]
+    projection = {"keywords": True, "num_keywords": True, "groups": True, "datetime": True, "spam": True}
+    for i in range(0, len(copies), 1000):
+        chunk = copies[i:i + 1000]
+        docs = list(tweets.find({"_id": {"$in": chunk}}, projection=projection))
+        tweets.delete_many({"_id": {"$in": chunk}})
+        update_rollups(rollups, [t for t in docs if t["keywords"]], sign=-1)
+        count_tweets(redis, docs, sign=-1)
+    if copies:
+        print("{}: removed {} duplicate tweets".format(tweets.name, len(copies)))
+
+
+def create_indexes():
+    for tweets in collections(db):
+        existing = tweets.index_information()
+        if id_index in existing and not existing[id_index].get("unique"):
+            remove_duplicates(tweets)
+            tweets.drop_index(id_index)
+        create_tweets_indexes(tweets)
+        existing = tweets.index_information()
+        for name in old_tweets_indexes:
+            if name in existing:
+                tweets.drop_index(name)
+
+    rollups.create_index([("keyword", 1), ("group", 1), ("hour", 1)], unique=True)  # api:/keywords/{keyword}/series
+    rollups.create_index([("group", 1), ("hour", 1)])                             # api:/keywords
+
+    stories.create_index([("groups", 1), ("datetime", 1)])       # storify.py:load_stories
 
-tweets.create_index([("num_keywords", 1), ("datetime", 1)])  # api:/keywords, statistics.py
-tweets.create_index([("groups", 1), ("datetime", 1)])        # api:/keywords, api:/groups/{group}
-tweets.create_index([("keywords", 1), ("datetime", 1)])      # api:/keywords/{keyword}/*
-tweets.create_index("tweet.id_str")                          # api:/tweet/{id_str}
 
-stories.create_index([("groups", 1), ("datetime", 1)])       # storify.py:load_stories
+if __name__ == "__main__":
+    create_indexes()
@@ -0,0 +1,269 @@
+"""Append-only log of the incoming tweets on the master, to stage them for the
+master instead of in redis. Enable it with `ingest_log = yes` in the
+`database:parameters` section of clustering/config.ini.
+
+The streamer appends every tweet to the log and sends its sequence number with
+the task to the workers, which pass it on to the master. The master reads the
+tweets from the log by their sequence numbers and marks them as inserted in a
+bitmap per segment in redis: a bit per tweet instead of the whole tweet.
+
+The log is split in segments of `SEGMENT_RECORDS` tweets in `ingest_log_dir`,
+named after the sequence number of their first tweet:
+
+    00000000000000100000.log     the records: a 4 byte length and the tweet JSON
+    00000000000000100000.index   the position of every record, 8 bytes each
+
+Tweets deleted by their users before they were inserted get a tombstone: their
+id in a sorted set with the end of the log at the time of the delete notice.
+The tombstones are kept until all the records before that position are done,
+however far behind the master is.
+
+Segments are deleted once all their tweets are inserted. The tweets in the log
+survive restarts of the streamer, the master and RabbitMQ: send the tweets that
+weren't inserted to the workers again and delete the inserted segments with:
+
+    python ingest_log.py --resend
+"""
+import argparse
+import os
+import struct
+from bisect import bisect_right
+from configparser import ConfigParser
+from os.path import dirname, isdir, join
+from threading import Lock
+
+import ujson as json
+from redis import StrictRedis
+
+
+config = ConfigParser()
+config.read(dirname(__file__) + "/../clustering/config.ini")
+enabled = config.getboolean("database:parameters", "ingest_log", fallback=False)
+log_dir = join(dirname(__file__), config.get("database:parameters", "ingest_log_dir", fallback="ingest"))
+
+SEGMENT_RECORDS = 100000
+DONE = "log:done:{}"  # bitmap of the inserted records of the segment
+TOMBSTONES = "log:tombstones"  # ids of deleted tweets, by the end of the log when they were deleted
+
+
+def segment_path(base, extension):
+    return join(log_dir, "{:020d}{}".format(base, extension))
+
+
+def segments():
+    """The sequence numbers of the first records of the segments, oldest first."""
+    if not isdir(log_dir):
+        return []
+    return sorted(int(f[:-len(".log")]) for f in os.listdir(log_dir) if f.endswith(".log"))
+
+
+def num_records(base):
+    """Number of records in the segment."""
+    return os.path.getsize(segment_path(base, ".index")) // 8
+
+
+def end():
+    """The sequence number of the next record."""
+    bases = segments()
+    return bases[-1] + num_records(bases[-1]) if bases else 0
+
+
+class Writer:
+    """Appends records to the log. Only one process writes: the streamer."""
+    def __init__(self):
+        os.makedirs(log_dir, exist_ok=True)
+        self.lock = Lock()
+        self.next_seq = end()
+        self.open_segment(self.next_seq)
+
+    def open_segment(self, base):
+        self.base = base
+        self.log = os.open(segment_path(base, ".log"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index = os.open(segment_path(base, ".index"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # a crash can leave half an index entry
+        size = os.fstat(self.index).st_size
+        os.ftruncate(self.index, size - size % 8)
+        self.position = os.fstat(self.log).st_size
+
+    def append(self, data):
+        """Append the bytes, returns their sequence number."""
+        with self.lock:
+            if self.next_seq - self.base >= SEGMENT_RECORDS:
+                os.close(self.log)
+                os.close(self.index)
+                self.open_segment(self.next_seq)
+            # the record before its index entry: an indexed record is complete
+            os.write(self.log, struct.pack("<I", len(data)) + data)
+            os.write(self.index, struct.pack("<Q", self.position))
+            self.position += 4 + len(data)
+            seq = self.next_seq
+            self.next_seq += 1
+            return seq
+
+    def close(self):
+        with self.lock:
+            os.close(self.log)
+            os.close(self.index)
+
+
+def locate(bases, seq):
+    """The segment base and the number of the record in the segment, None
+    when its segment was deleted."""
+    i = bisect_right(bases, seq) - 1
+    if i < 0:
+        return None, None
+    return bases[i], seq - bases[i]
+
+
+def read_many(seqs):
+    """The records with the sequence numbers."""
+    bases = segments()
+    records = {}
+    by_segment = {}
+    for seq in seqs:
+        base, i = locate(bases, seq)
+        by_segment.setdefault(base, []).append((seq, i))
+    for (base, items) in by_segment.items():
+        with open(segment_path(base, ".index"), "rb") as index, open(segment_path(base, ".log"), "rb") as log:
+            for (seq, i) in sorted(items, key=lambda item: item[1]):
+                index.seek(i * 8)
+                position, = struct.unpack("<Q", index.read(8))
+                log.seek(position)
+                length, = struct.unpack("<I", log.read(4))
+                records[seq] = log.read(length)
+    return [records[seq] for seq in seqs]
+
+
+def read_new(redis, seqs):
+    """The records with the sequence numbers, None for those already inserted."""
+    bases = segments()
+    located = [(seq, locate(bases, seq)) for seq in seqs]
+    # the segments that were deleted are done
+    located = [(seq, base, i) for (seq, (base, i)) in located if base is not None]
+    pipe = redis.pipeline()
+    for (_, base, i) in located:
+        pipe.getbit(DONE.format(base), i)
+    new = [seq for ((seq, _, _), done) in zip(located, pipe.execute()) if not done]
+    records = dict(zip(new, read_many(new)))
+    return [records.get(seq) for seq in seqs]
+
+
+def mark_done(redis, seqs):
+    """Mark the records as inserted, and delete the segments that are done."""
+    if not seqs:
+        return
+    bases = segments()
+    touched = set()
+    pipe = redis.pipeline()
+    for seq in seqs:
+        base, i = locate(bases, seq)
+        if base is not None:
+            pipe.setbit(DONE.format(base), i, 1)
+            touched.add(base)
+    pipe.execute()
+    for base in touched:
+        remove_if_done(redis, bases, base)
+    prune_tombstones(redis)
+
+
+def remove_if_done(redis, bases, base):
+    """Delete the segment when all its records are inserted and the streamer
+    moved on to a newer segment."""
+    if base == bases[-1] or redis.bitcount(DONE.format(base)) < num_records(base):
+        return
+    for extension in [".log", ".index"]:
+        try:
+            os.remove(segment_path(base, extension))
+        except FileNotFoundError:
+            pass
+    redis.delete(DONE.format(base))
+
+
+def add_tombstones(redis, id_strs):
+    """Remember the deleted tweets, until the records they can be in are done.
+    A tweet is in the log before its delete notice, so before the end of the log."""
+    position = end()
+    redis.zadd(TOMBSTONES, {id_str: position for id_str in id_strs})
+
+
+def tombstoned(redis, id_strs):
+    """The tweets of the ids that have a tombstone."""
+    pipe = redis.pipeline()
+    for id_str in id_strs:
+        pipe.zscore(TOMBSTONES, id_str)
+    return {id_str for (id_str, position) in zip(id_strs, pipe.execute()) if position is not None}
+
+
+def prune_tombstones(redis):
+    """Drop the tombstones of the tweets that can't be in the log anymore: all
+    the records before the oldest segment are done."""
+    bases = segments()
+    if bases:
+        redis.zremrangebyscore(TOMBSTONES, "-inf", bases[0])
+
+
+def backlog(redis):
+    """The number of records that weren't inserted."""
+    bases = segments()
+    pipe = redis.pipeline()
+    for base in bases:
+        pipe.bitcount(DONE.format(base))
+    n = 0
+    for (base, done) in zip(bases, pipe.execute()):
+        try:
+            n += num_records(base) - done
+        except FileNotFoundError:
+            pass  # the master deleted the segment, it's done
+    return n
+
+
+def not_done(redis):
+    """The sequence numbers of the records that weren't inserted."""
+    for base in segments():
+        done = redis.get(DONE.format(base)) or b""
+        for i in range(num_records(base)):
+            byte = done[i // 8] if i // 8 < len(done) else 0
+            if not byte & (0x80 >> (i % 8)):  # redis counts the bits from the most significant one
+                yield base + i
+
+
+def resend(redis, batch_size=100):
+    """Send the tweets in the log that weren't inserted to the workers again."""
+    # the task as the workers know it, see streamer.py
+    from tasks_workers import find_keywords_and_groups_batch
+
+    def send(seqs):
+        tweets = []
+        for data in read_many(seqs):
+            j = json.loads(data)
+            rt = j["retweeted_status"]["id_str"] if "retweeted_status" in j else None
+            tweets.append((j["id_str"], j["text"], rt))
+        refs = {id_str: seq for ((id_str, _, _), seq) in zip(tweets, seqs)}
+        find_keywords_and_groups_batch.apply_async((tweets,), {"refs": refs}, queue="workers")
+
+    seqs = []
+    for seq in not_done(redis):
+        seqs.append(seq)
+        if len(seqs) == batch_size:
+            send(seqs)
+            seqs = []
+    if seqs:
+        send(seqs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="The ingest log of the tweets.")
+    parser.add_argument("--resend", action="store_true", help="send the tweets that weren't inserted again")
+    args = parser.parse_args()
+
+    redis = StrictRedis()
+    bases = segments()
+    for base in bases:
+        remove_if_done(redis, bases, base)
+    prune_tombstones(redis)
+    if args.resend:
+        resend(redis)
+
+
+if __name__ == "__main__":
+    main()
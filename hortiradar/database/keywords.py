@@ -1,14 +1,23 @@
+from collections import defaultdict
+from threading import Thread
+from time import sleep
+
 import attr
-import frog
 import pymongo
 import ujson as json
 
-from hortiradar import Tweety, TOKEN
+from hortiradar import Tweety
+from hortiradar.database import api_cache
 
 
 DATABASE = None
 FROG = None
 
+# the version of the keyword registry (all groups with their keywords) in redis
+# on the master, incremented and published on this channel on every change
+KEYWORDS_VERSION = "keywords:version"
+KEYWORDS_CHANNEL = "keywords"
+
 
 @attr.s(slots=True)
 class Keyword:
@@ -24,46 +33,87 @@ def get_keywords(local=False):
 
     Set `local` to `True` if running on the same server as the database.
     """
+    if local:
+        groups = get_db().groups.find({}, projection={"name": True, "keywords": True, "_id": False})
+    else:
+        from hortiradar import TOKEN  # only the API needs the secrets, the tests run without them
+        tweety = Tweety("https://acba.labs.vu.nl/hortiradar/api/", TOKEN)
+        groups = json.loads(tweety.get_groups(expand="keywords"))
     keywords = {}
-    groups = request_groups(local)
-    for group_name in groups:
-        words = request_keywords(group_name, local)
-        for k in words:
-            if k.lemma in keywords:
-                keywords[k.lemma].groups.append(group_name)
+    for group in groups:
+        for keyword in group.get("keywords", []):  # new groups don't have keywords yet
+            lemma = keyword["lemma"]
+            if lemma in keywords:
+                keywords[lemma].groups.append(group["name"])
             else:
-                k.groups.append(group_name)
-                keywords[k.lemma] = k
+                keywords[lemma] = Keyword(lemma=lemma, pos=keyword["pos"], groups=[group["name"]])
     return keywords
 
 
-def request_groups(local=False):
-    if local:
-        db = pymongo.MongoClient().twitter
-        gs = db.groups.find({}, projection={"name": True, "_id": False})
-        groups = [g["name"] for g in gs]
-    else:
-        tweety = Tweety("https://acba.labs.vu.nl/hortiradar/api/", TOKEN)
-        groups = json.loads(tweety.get_groups())
-    return groups
+@attr.s(slots=True, frozen=True)
+class KeywordSnapshot:
+    """The keywords at a version of the registry, with the keywords of every
+    group precompiled. Snapshots are never changed, swap in a new one."""
+    version = attr.ib()
+    keywords = attr.ib()
+    groups = attr.ib()
 
 
-def request_keywords(group, local=False):
-    """Returns a list of Keyword objects from the keywords in the group."""
-    if local:
-        db = pymongo.MongoClient().twitter
-        try:
-            g = db.groups.find_one({"name": group})["keywords"]
-        except KeyError:        # new groups don't have keywords yet
-            g = []
-    else:
-        tweety = Tweety("https://acba.labs.vu.nl/hortiradar/api/", TOKEN)
-        g = json.loads(tweety.get_group(group))
-    keywords = []
-    for keyword in g:
-        k = Keyword(lemma=keyword["lemma"], pos=keyword["pos"])
-        keywords.append(k)
-    return keywords
+def make_snapshot(version, keywords):
+    groups = defaultdict(list)
+    for (lemma, k) in keywords.items():
+        for group in k.groups:
+            groups[group].append(lemma)
+    return KeywordSnapshot(version=version, keywords=keywords, groups=dict(groups))
+
+
+def get_keywords_version(redis):
+    return int(redis.get(KEYWORDS_VERSION) or 0)
+
+
+def bump_keywords_version(redis):
+    """Call after changing the groups, returns the new version. The cached API
+    responses about the groups count their old keywords, they're dropped."""
+    version = redis.incr(KEYWORDS_VERSION)
+    api_cache.invalidate_groups()
+    redis.publish(KEYWORDS_CHANNEL, version)
+    return version
+
+
+def fetch_keywords_version():
+    """The version of the keyword registry from the API, for the workers that
+    don't have the master's redis."""
+    from hortiradar import TOKEN
+    tweety = Tweety("https://acba.labs.vu.nl/hortiradar/api/", TOKEN)
+    return json.loads(tweety.get_registry())["version"]
+
+
+def announce_keywords(redis):
+    """Tell the API processes and the workers that the groups changed."""
+    from hortiradar.database import app
+    from hortiradar.database.tasks_workers import KEYWORDS_CHANGED_TASK
+    version = bump_keywords_version(redis)
+    # by the name the workers run it under, not of the package's copy of the task
+    app.signature(KEYWORDS_CHANGED_TASK, args=(version,)).apply_async(queue="broadcast")
+
+
+def watch_keywords(redis, callback):
+    """Calls `callback(version)` in a daemon thread for every published version
+    of the registry, and with the current version whenever it (re)subscribes so
+    no versions are missed while disconnected."""
+    def listen():
+        while True:
+            try:
+                pubsub = redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(KEYWORDS_CHANNEL)
+                callback(get_keywords_version(redis))
+                for message in pubsub.listen():
+                    callback(int(message["data"]))
+            except Exception:
+                # lost the connection or failed to load the snapshot: start over
+                sleep(5)
+
+    Thread(target=listen, daemon=True).start()
 
 
 def read_keywords(filename):
@@ -111,6 +161,7 @@ def get_frog():
     """
     global FROG
     if FROG is None:
+        import frog  # imported here so everything that doesn't use frog runs without it
         FROG = frog.Frog(frog.FrogOptions(
             tok=True, lemma=True, morph=False, daringmorph=False, mwu=True,
             chunking=False, ner=False, parser=False
@@ -0,0 +1,148 @@
+"""Ingest metrics: the latency of every stage of a tweet on its way from the
+streamer to MongoDB, throughput counters and the backlog of tweets staged for
+the master (in redis or the ingest log), aggregated in the master's redis.
+
+The backlog counts the tweets in redis that are staged and not removed yet, and
+the records of the ingest log that aren't done: with the ingest log the API
+reads its directory, so run the API on the host of the streamer and master.
+
+The streamer stamps the time a tweet was received in the task to the workers,
+the workers add when they started and finished, and the master records the
+latencies with its own times when it inserts the tweets. The times of the
+different hosts are compared, so keep their clocks synchronized (NTP).
+
+The stages:
+
+    queue_workers   received by the streamer until a worker starts on it
+    worker          analysis by a worker (for a whole batch)
+    queue_master    worker finished until the master inserts it
+    master          insert by the master (for a whole batch)
+    total           received by the streamer until inserted
+"""
+from time import time
+
+from hortiradar.database import ingest_log
+
+
+STAGES = ["queue_workers", "worker", "queue_master", "master", "total"]
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]  # seconds
+
+LATENCY = "metrics:latency:"  # hash per stage with the bucket counts, sum and count
+COUNTERS = "metrics:counters"  # hash with the number of tweets: received, inserted and deletes
+STAGED = "metrics:staged"  # the number of tweets staged in redis
+FROG_CACHE = "metrics:frog_cache"  # hash with the lookups in the workers' Frog cache per result
+FROG_CACHE_RESULTS = ["memory", "redis", "batch", "miss"]
+PREFILTER = "metrics:prefilter"  # hash with the sampled tweets the prefilter skipped, and those with keywords
+PREFILTER_RESULTS = ["sampled", "missed"]
+
+
+def observe(pipe, stage, seconds, n=1):
+    """Record n observations of a latency in seconds."""
+    bucket = next((str(b) for b in BUCKETS if seconds <= b), "+Inf")
+    key = LATENCY + stage
+    pipe.hincrby(key, bucket, n)
+    pipe.hincrbyfloat(key, "sum", seconds * n)
+    pipe.hincrby(key, "count", n)
+
+
+def count_received(redis, n=1):
+    redis.hincrby(COUNTERS, "received", n)
+
+
+def count_staged(redis, n=1):
+    redis.incrby(STAGED, n)
+
+
+def backlog(redis):
+    """The number of tweets staged for the master that it didn't insert or skip yet."""
+    staged = int(redis.get(STAGED) or 0)
+    if ingest_log.enabled:
+        staged += ingest_log.backlog(redis)
+    return staged
+
+
+def count_deletes(redis, notices, deleted, purged):
+    """Count the delete notices, the tweets they deleted from the database and
+    those they removed from the staging area before they were inserted."""
+    pipe = redis.pipeline()
+    pipe.hincrby(COUNTERS, "delete_notices", notices)
+    pipe.hincrby(COUNTERS, "deleted", deleted)
+    pipe.hincrby(COUNTERS, "purged", purged)
+    pipe.decrby(STAGED, purged)
+    pipe.execute()
+
+
+def record_insert(redis, stamps, master_start, inserted, unstaged):
+    """Record the latencies and Frog cache lookups of the tasks with `stamps`
+    (from the worker tasks), the number of inserted tweets and the number of
+    tweets removed from the staging area in redis."""
+    master_done = time()
+    pipe = redis.pipeline()
+    for s in stamps:
+        if not s or "worker_start" not in s:
+            continue  # tasks sent before there were stamps
+        for received in s.get("received", []):
+            observe(pipe, "queue_workers", s["worker_start"] - received)
+            observe(pipe, "total", master_done - received)
+        observe(pipe, "worker", s["worker_done"] - s["worker_start"])
+        observe(pipe, "queue_master", master_start - s["worker_done"])
+        for (result, n) in s.get("frog_cache", {}).items():
+            pipe.hincrby(FROG_CACHE, result, n)
+        for (result, n) in s.get("prefilter", {}).items():
+            pipe.hincrby(PREFILTER, result, n)
+    observe(pipe, "master", master_done - master_start)
+    pipe.hincrby(COUNTERS, "inserted", inserted)
+    pipe.decrby(STAGED, unstaged)
+    pipe.execute()
+
+
+def render(redis):
+    """The metrics in the Prometheus text format."""
+    lines = [
+        "# HELP hortiradar_ingest_latency_seconds Latency of the ingest stages.",
+        "# TYPE hortiradar_ingest_latency_seconds histogram",
+    ]
+    pipe = redis.pipeline()
+    for stage in STAGES:
+        pipe.hgetall(LATENCY + stage)
+    pipe.hgetall(COUNTERS)
+    pipe.hgetall(FROG_CACHE)
+    pipe.hgetall(PREFILTER)
+    *latencies, counters, frog_cache, prefilter = pipe.execute()
+    for (stage, h) in zip(STAGES, latencies):
+        cumulative = 0
+        for b in [str(b) for b in BUCKETS] + ["+Inf"]:
+            cumulative += int(h.get(b.encode(), 0))
+            lines.append('hortiradar_ingest_latency_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, b, cumulative))
+        lines.append('hortiradar_ingest_latency_seconds_sum{{stage="{}"}} {}'.format(stage, float(h.get(b"sum", 0))))
+        lines.append('hortiradar_ingest_latency_seconds_count{{stage="{}"}} {}'.format(stage, int(h.get(b"count", 0))))
+
+    counts = {k.decode(): int(v) for (k, v) in counters.items()}
+    lines += [
+        "# HELP hortiradar_ingest_tweets_total Tweets received by the streamer and inserted by the master.",
+        "# TYPE hortiradar_ingest_tweets_total counter",
+        'hortiradar_ingest_tweets_total{{event="received"}} {}'.format(counts.get("received", 0)),
+        'hortiradar_ingest_tweets_total{{event="inserted"}} {}'.format(counts.get("inserted", 0)),
+        "# HELP hortiradar_ingest_backlog Tweets staged for the master that it didn't insert yet.",
+        "# TYPE hortiradar_ingest_backlog gauge",
+        "hortiradar_ingest_backlog {}".format(backlog(redis)),
+        "# HELP hortiradar_deletes_total Delete notices, and the tweets they deleted from the database or staging.",
+        "# TYPE hortiradar_deletes_total counter",
+        'hortiradar_deletes_total{{result="notices"}} {}'.format(counts.get("delete_notices", 0)),
+        'hortiradar_deletes_total{{result="deleted"}} {}'.format(counts.get("deleted", 0)),
+        'hortiradar_deletes_total{{result="purged"}} {}'.format(counts.get("purged", 0)),
+        "# HELP hortiradar_frog_cache_total Lookups in the workers' Frog cache, only misses are analyzed by Frog.",
+        "# TYPE hortiradar_frog_cache_total counter",
+    ]
+    for result in FROG_CACHE_RESULTS:
+        lines.append('hortiradar_frog_cache_total{{result="{}"}} {}'.format(
+            result, int(frog_cache.get(result.encode(), 0))))
+    lines += [
+        "# HELP hortiradar_prefilter_sample_total Tweets skipped by the prefilter that Frog analyzed anyway, "
+        "and those of them with keywords (the lost recall).",
+        "# TYPE hortiradar_prefilter_sample_total counter",
+    ]
+    for result in PREFILTER_RESULTS:
+        lines.append('hortiradar_prefilter_sample_total{{result="{}"}} {}'.format(
+            result, int(prefilter.get(result.encode(), 0))))
+    return "\n".join(lines) + "\n"
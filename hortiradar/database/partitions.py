@@ -0,0 +1,225 @@
+"""Routing of the tweets to their collections. With `partitioned = yes` in the
+`database:parameters` section of clustering/config.ini the tweets are stored in
+monthly collections named `tweets_YYYYMM` after the month of the tweet,
+otherwise they're all in `tweets`.
+
+Range queries go through `find` and `aggregate`, which take the datetime range
+from the query and only query the partitions of those months. Single tweets are
+routed by their id: tweet ids contain the time the tweet was sent.
+
+Move the tweets of an existing `tweets` collection to the partitions with:
+
+    python partitions.py --migrate
+
+It drops the `tweets` collection once all its tweets are in the partitions.
+"""
+import argparse
+from collections import OrderedDict
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+from os.path import dirname
+
+from hortiradar.database import get_db
+
+
+config = ConfigParser()
+config.read(dirname(__file__) + "/../clustering/config.ini")
+partitioned = config.getboolean("database:parameters", "partitioned", fallback=False)
+
+# milliseconds since the epoch of Twitter's snowflake ids
+SNOWFLAKE_EPOCH = 1288834974657
+EPOCH = datetime(1970, 1, 1)
+
+# the indexes of every tweets collection, with their users
+TWEETS_INDEXES = [
+    ([("num_keywords", 1), ("datetime", 1)], {}),            # api:/keywords
+    ([("groups", 1), ("datetime", 1)], {}),                  # api:/keywords, api:/groups/{group}
+    # api:/keywords/{keyword}/*, with pages and without spam
+    ([("keywords", 1), ("datetime", 1), ("_id", 1), ("spam", 1)], {}),
+    # api:/tweet/{id_str}, unique: the master skips the tweets of redelivered tasks
+    ([("tweet.id_str", 1)], {"unique": True}),
+]
+
+# the partitions that have their indexes, in this process
+indexed = set()
+
+# per database the (month, partition names) that collections() listed, listed
+# again in a new month until the master made the partition of that month
+names_cache = {}
+
+
+def create_tweets_indexes(collection):
+    for (keys, options) in TWEETS_INDEXES:
+        collection.create_index(keys, **options)
+    indexed.add(collection.name)
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def next_month(dt):
+    return month_start(month_start(dt) + timedelta(days=31))
+
+
+def partition_name(dt):
+    return "tweets_" + dt.strftime("%Y%m")
+
+
+def partition_month(name):
+    return datetime.strptime(name[len("tweets_"):], "%Y%m")
+
+
+def tweet_datetime(id_str):
+    """The time a tweet was sent, from its id."""
+    return EPOCH + timedelta(milliseconds=(int(id_str) >> 22) + SNOWFLAKE_EPOCH)
+
+
+def partition_names(db):
+    """Names of all partitions, oldest first."""
+    return sorted(name for name in db.list_collection_names()
+                  if name.startswith("tweets_") and name[len("tweets_"):].isdigit())
+
+
+def cached_partition_names(db):
+    """The names of all partitions, without listing the collections for every query."""
+    now = datetime.utcnow()
+    month, names = names_cache.get(db.name, (None, []))
+    if month != month_start(now) or partition_name(now) not in names:
+        names = partition_names(db)
+        names_cache[db.name] = (month_start(now), names)
+    return names
+
+
+def collections(db, start=None, end=None):
+    """The tweets collections with the tweets from start to end, oldest first."""
+    if not partitioned:
+        return [db.tweets]
+    names = cached_partition_names(db)
+    if start is not None:
+        names = [n for n in names if next_month(partition_month(n)) > start]
+    if end is not None:
+        names = [n for n in names if partition_month(n) < end]
+    return [db[n] for n in names]
+
+
+def collection_for(db, dt):
+    """The collection for the tweets with datetime dt."""
+    if not partitioned:
+        return db.tweets
+    collection = db[partition_name(dt)]
+    if collection.name not in indexed:
+        create_tweets_indexes(collection)
+    return collection
+
+
+def collection_for_id(db, id_str):
+    """The collection with the tweet with id_str."""
+    if not partitioned:
+        return db.tweets
+    return db[partition_name(tweet_datetime(id_str))]
+
+
+def split(db, tweets):
+    """Groups the tweet documents by their collection: a list of (collection, tweets)."""
+    parts = OrderedDict()
+    for t in tweets:
+        parts.setdefault(partition_name(t["datetime"]), []).append(t)
+    return [(collection_for(db, ts[0]["datetime"]), ts) for ts in parts.values()]
+
+
+def query_range(query):
+    """The (start, end) of the datetime range of a tweets query."""
+    dt = query.get("datetime", {})
+    return dt.get("$gte", dt.get("$gt")), dt.get("$lt", dt.get("$lte"))
+
+
+def find(db, query, projection=None, sort=None, limit=0):
+    """Find the tweets matching the query in the partitions of its datetime
+    range, one partition after the other: a sort on datetime stays sorted."""
+    start, end = query_range(query)
+    for collection in collections(db, start, end):
+        cursor = collection.find(query, projection=projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        n = 0
+        for t in cursor:
+            n += 1
+            yield t
+        if limit:
+            limit -= n
+            if limit <= 0:
+                return
+
+
+def aggregate(db, pipeline):
+    """Runs the aggregation pipeline, starting with a $match on a datetime
+    range, on every partition in the range. The results of the partitions come
+    one after the other, combine them."""
+    start, end = query_range(pipeline[0]["$match"])
+    for collection in collections(db, start, end):
+        yield from collection.aggregate(pipeline, allowDiskUse=True)
+
+
+def count_copied(source, target, query, chunk_size=10000):
+    """The number of tweets of the query in source, and how many of them are in target."""
+    expected = copied = 0
+    ids = []
+    for t in source.find(query, projection={"tweet.id_str": True, "_id": False}):
+        ids.append(t["tweet"]["id_str"])
+        if len(ids) == chunk_size:
+            expected, copied = expected + len(ids), copied + target.count_documents({"tweet.id_str": {"$in": ids}})
+            ids = []
+    if ids:
+        expected, copied = expected + len(ids), copied + target.count_documents({"tweet.id_str": {"$in": ids}})
+    return expected, copied
+
+
+def migrate(db):
+    """Move the tweets from the `tweets` collection to the partitions, per
+    month. The tweets the master already inserted in a partition are kept. The
+    `tweets` collection is dropped when the partitions have all its tweets,
+    otherwise the migration stops and it's kept."""
+    # the partitions have a unique index on the tweet ids
+    from indexes import remove_duplicates
+    remove_duplicates(db.tweets)
+
+    first = db.tweets.find_one(sort=[("datetime", 1)])
+    last = db.tweets.find_one(sort=[("datetime", -1)])
+    if not first:
+        return
+    total = db.tweets.count_documents({})
+    moved = 0
+    month = month_start(first["datetime"])
+    while month <= last["datetime"]:
+        name = partition_name(month)
+        query = {"datetime": {"$gte": month, "$lt": next_month(month)}}
+        create_tweets_indexes(db[name])  # $merge on the tweet ids needs their unique index
+        db.tweets.aggregate([
+            {"$match": query},
+            {"$merge": {"into": name, "on": "tweet.id_str", "whenMatched": "keepExisting", "whenNotMatched": "insert"}},
+        ], allowDiskUse=True)
+        expected, copied = count_copied(db.tweets, db[name], query)
+        print(name, copied)
+        if copied != expected:
+            raise SystemExit("{}: copied {} of {} tweets, the tweets collection is kept".format(name, copied, expected))
+        moved += copied
+        month = next_month(month)
+    if moved != total:
+        raise SystemExit("moved {} of {} tweets, the tweets collection is kept".format(moved, total))
+    db.tweets.drop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly partitions of the tweets.")
+    parser.add_argument("--migrate", action="store_true", help="move the tweets collection to the partitions, and drop it")
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate(get_db())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compact serialization of the Celery messages from the workers to the master,
+registered with kombu as `hortiradar-msgpack` in selderij.py.
+
+The messages are MessagePack, with every list of Frog tokens in columns: a list
+per key instead of a dict per token, the lemma left out (nil) when it's the
+same as the text and the part-of-speech tags as indexes in a table of the tags
+in the message. The table comes first, followed by the message body:
+
+    ["N(soort,ev,basis,zijd,stan)", "LET()", ...] [args, kwargs, embed]
+
+A process can only read these messages when it has the serializer in its
+`accept_content`, upgrade the master before it's used by the workers.
+"""
+import msgpack
+
+
+NAME = "hortiradar-msgpack"
+CONTENT_TYPE = "application/x-hortiradar-msgpack"
+TOKENS = 1  # msgpack extension type of a list of tokens
+
+
+def is_tokens(obj):
+    """Whether obj is a non-empty list of token dicts with the same keys."""
+    if not obj or not isinstance(obj[0], dict):
+        return False
+    keys = obj[0].keys()
+    return "text" in keys and "lemma" in keys and "pos" in keys and \
+        all(isinstance(t, dict) and t.keys() == keys for t in obj)
+
+
+def pack_tokens(tokens, tags):
+    keys = list(tokens[0])
+    columns = []
+    for key in keys:
+        if key == "lemma":
+            columns.append([None if t["lemma"] == t["text"] else t["lemma"] for t in tokens])
+        elif key == "pos":
+            columns.append([tags.setdefault(t["pos"], len(tags)) for t in tokens])
+        else:
+            columns.append([t[key] for t in tokens])
+    return msgpack.ExtType(TOKENS, msgpack.packb([keys, columns], use_bin_type=True))
+
+
+def unpack_tokens(data, tags):
+    keys, columns = msgpack.unpackb(data, raw=False)
+    columns = dict(zip(keys, columns))
+    columns["lemma"] = [text if lemma is None else lemma for (text, lemma) in zip(columns["text"], columns["lemma"])]
+    columns["pos"] = [tags[i] for i in columns["pos"]]
+    return [dict(zip(keys, row)) for row in zip(*(columns[k] for k in keys))]
+
+
+def compact(obj, tags):
+    """Replace the token lists in obj with their columns."""
+    if isinstance(obj, (list, tuple)):
+        if is_tokens(obj):
+            return pack_tokens(obj, tags)
+        return [compact(o, tags) for o in obj]
+    if isinstance(obj, dict):
+        return {k: compact(v, tags) for (k, v) in obj.items()}
+    return obj
+
+
+def dumps(body):
+    tags = {}
+    body = compact(body, tags)
+    return msgpack.packb(list(tags), use_bin_type=True) + msgpack.packb(body, use_bin_type=True)
+
+
+def loads(data):
+    tags = []
+
+    def ext_hook(code, data):
+        if code == TOKENS:
+            return unpack_tokens(data, tags)
+        return msgpack.ExtType(code, data)
+
+    unpacker = msgpack.Unpacker(raw=False, ext_hook=ext_hook)
+    unpacker.feed(data)
+    tags.extend(next(unpacker))  # the extensions are only unpacked with the body
+    return next(unpacker)
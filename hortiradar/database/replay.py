@@ -0,0 +1,288 @@
+"""Replay of recorded tweets through the ingest pipeline on one machine, without
+Twitter, Frog or a broker: the statuses go through the streamer (clean_tweet,
+filter_tweet), the workers (keyword matching) and the master (insert_tweet) with
+the Celery tasks executed eagerly. Frog is replaced by a deterministic
+tokenizer and the keywords are read from the wordlists in data/.
+
+The recording has one message of the streaming API per line: raw statuses
+(`status._json`) and delete notices, other messages are skipped. The tweets go
+to the `twitter_replay` database and redis databases 14 (workers) and 15
+(streamer and master), which are emptied. With `--fake` they go to in-memory
+stand-ins instead (pip install mongomock fakeredis). With `--ingest-log` the
+tweets are staged in an ingest log in a temporary directory instead of in redis.
+
+Reports the tweets/s and the time per tweet of every stage, for every batch
+size of the streamer. Fails when the database doesn't have exactly the tweets
+that weren't deleted, or when tweets are left staged:
+
+    python replay.py tweets.jsonl --batch-size 1 20
+"""
+import argparse
+import re
+import shutil
+import sys
+from collections import defaultdict
+from configparser import ConfigParser
+from functools import wraps
+from os.path import basename, dirname, splitext
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+import pymongo
+import ujson as json
+from redis import StrictRedis
+
+import ingest_log
+import streamer
+import tasks_workers
+from hortiradar.database import app, metrics, partitions, tasks_master
+from keywords import Keyword, read_keywords
+
+
+class FakeFrog:
+    """Deterministic stand-in for Frog: every word is its own lowercase lemma,
+    with the part of speech of the keyword it matches. `delay` seconds are
+    spent on every call, as Frog has a cost per call."""
+    def __init__(self, keywords, delay=0):
+        self.keywords = keywords
+        self.delay = delay
+
+    def process(self, text):
+        if self.delay:
+            sleep(self.delay)
+        tokens = []
+        for (i, word) in enumerate(re.findall(r"\w+|[^\w\s]+", text), 1):
+            lemma = word if word in self.keywords else word.lower()  # names are capitalized
+            if lemma in self.keywords:
+                pos = self.keywords[lemma].pos + "()"
+            elif re.match(r"\w", word):
+                pos = "N(soort,ev,basis,zijd,stan)"
+            else:
+                pos = "LET()"
+            tokens.append({"index": str(i), "text": word, "lemma": lemma, "pos": pos, "posprob": 0.9})
+        return tokens
+
+
+class Stages:
+    """Time spent in the functions of the ingest stages."""
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.active = set()
+
+    def wrap(self, module, name):
+        """Replace the function `name` in `module` with one that is timed."""
+        f = getattr(module, name)
+
+        @wraps(f)
+        def timed(*args, **kwargs):
+            if name in self.active:  # recursion, e.g. clean_tweet of a retweet
+                return f(*args, **kwargs)
+            self.active.add(name)
+            t0 = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.seconds[name] += perf_counter() - t0
+                self.active.discard(name)
+
+        setattr(module, name, timed)
+
+
+# the stages with the functions that are timed, indented stages are part of the one above
+STAGES = [
+    (streamer, "clean_tweet", 0),
+    (streamer, "filter_tweet", 0),
+    (tasks_workers, "analyze_tweets", 0),
+    (tasks_workers, "frog_process", 1),
+    (tasks_workers, "match_keywords", 1),
+    (tasks_master, "insert_tweets", 0),
+]
+
+
+def load_keywords(filenames):
+    """The keywords of the wordlists, every wordlist is a group named after the file."""
+    keywords = {}
+    for filename in filenames:
+        group = splitext(basename(filename))[0]
+        for k in read_keywords(filename):
+            if k.lemma in keywords:
+                keywords[k.lemma].groups.append(group)
+            else:
+                keywords[k.lemma] = Keyword(lemma=k.lemma, pos=k.pos, groups=[group])
+    return keywords
+
+
+def read_messages(filename, limit):
+    """The raw statuses and delete notices in the recording, up to `limit` statuses."""
+    messages = []
+    statuses = 0
+    with open(filename) as f:
+        for line in f:
+            j = json.loads(line)
+            if "delete" in j:
+                messages.append(line)
+            elif "id_str" in j and "text" in j:
+                messages.append(line)
+                statuses += 1
+                if statuses == limit:
+                    break
+    return messages
+
+
+def configure(db, redis, worker_redis, keywords, frog_delay=0):
+    """Run the pipeline in this process on the databases, with a fake Frog
+    and the Celery tasks executed eagerly. Returns the Stages that time it."""
+    app.conf.update(task_always_eager=True, task_eager_propagates=True)
+    frog = FakeFrog(keywords, frog_delay)
+    streamer.redis = redis
+    tasks_master.db, tasks_master.redis = db, redis
+    tasks_master.api_cache.redis = redis
+    tasks_workers.redis = worker_redis
+    config = ConfigParser()
+    config.read(dirname(__file__) + "/tasks_workers.ini")
+    tasks_workers.posprob_minimum = config["workers"].getfloat("posprob_minimum")
+    tasks_workers.rt_cache_time = 60 * 60 * 6
+    tasks_workers.serializer = config["workers"].get("serializer", fallback="json")  # unused when eager
+    tasks_workers.frog_cache_size = config["workers"].getint("frog_cache_size", fallback=10000)
+    tasks_workers.prefilter_sample = config["workers"].getfloat("prefilter_sample", fallback=0.01)
+    tasks_workers.get_frog = lambda: frog
+    tasks_workers.get_keywords = lambda: keywords
+    tasks_workers.fetch_keywords_version = lambda: 0
+    tasks_workers.refresh_keywords()
+    stages = Stages()
+    for (module, name, _) in STAGES:
+        stages.wrap(module, name)
+    return stages
+
+
+def reset(mongo, redis, worker_redis, log_dir=None):
+    mongo.drop_database("twitter_replay")
+    partitions.indexed.clear()
+    partitions.names_cache.clear()
+    redis.flushdb()
+    worker_redis.flushdb()
+    tasks_workers.frog_cache = tasks_workers.FrogCache(
+        worker_redis, tasks_workers.frog_cache_size, tasks_workers.rt_cache_time)
+    # the streamer and the master import their own ingest_log module
+    for module in [ingest_log, tasks_master.ingest_log]:
+        module.enabled = log_dir is not None
+        module.log_dir = log_dir or module.log_dir
+
+
+def status_ids(messages):
+    """The ids of the statuses in the messages, and those of the deleted tweets."""
+    parsed = [json.loads(m) for m in messages]
+    ids = {j["id_str"] for j in parsed if "delete" not in j}
+    deleted = {j["delete"]["status"]["id_str"] for j in parsed if "delete" in j}
+    return ids, deleted
+
+
+def stored_ids(db):
+    """The ids of the tweets in the database."""
+    return {t["tweet"]["id_str"] for c in partitions.collections(db)
+            for t in c.find({}, projection={"tweet.id_str": True})}
+
+
+def num_staged(redis):
+    """The number of tweets staged for the master, in redis and the ingest log."""
+    staged = sum(1 for _ in redis.scan_iter("t:*"))
+    if ingest_log.enabled:
+        staged += sum(1 for _ in ingest_log.not_done(redis))
+    return staged
+
+
+def replay(messages, batch_size, delete_batch_size=1000):
+    """Feed the messages to the streamer, returns the seconds it took."""
+    messages = [json.loads(m) for m in messages]
+    # the batches are only sent when full, the rest at the end
+    listener = streamer.StreamListener(None, batch_size, batch_interval=60 * 60 * 24,
+                                       delete_batch_size=delete_batch_size, delete_interval=60 * 60 * 24)
+    t0 = perf_counter()
+    for j in messages:
+        if "delete" in j:
+            status = j["delete"]["status"]
+            listener.on_delete(status["id_str"], status["user_id_str"])
+        else:
+            listener.on_status(SimpleNamespace(_json=j))
+    if listener.batcher and listener.batcher.items:
+        streamer.send_to_workers(listener.batcher.items)
+        listener.batcher.items = []
+    if listener.deletes.items:
+        streamer.send_deletes(listener.deletes.items)
+        listener.deletes.items = []
+    seconds = perf_counter() - t0
+    if listener.log:
+        listener.log.close()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded tweets through the ingest pipeline.")
+    parser.add_argument("recording", help="JSONL file with a raw status per line")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 20], help="batch sizes of the streamer")
+    parser.add_argument("--limit", type=int, default=0, help="replay at most this many tweets")
+    parser.add_argument("--frog-delay", type=float, default=0, help="seconds per call of the fake Frog")
+    parser.add_argument("--wordlist", nargs="+", default=[dirname(__file__) + "/data/flowers.txt",
+                                                          dirname(__file__) + "/data/fruitsandveg.txt"])
+    parser.add_argument("--fake", action="store_true", help="use in-memory stand-ins for MongoDB and redis")
+    parser.add_argument("--ingest-log", action="store_true", help="stage the tweets in an ingest log")
+    args = parser.parse_args()
+
+    if args.fake:
+        import fakeredis
+        import mongomock
+        mongo = mongomock.MongoClient()
+        redis, worker_redis = fakeredis.FakeStrictRedis(db=15), fakeredis.FakeStrictRedis(db=14)
+    else:
+        mongo = pymongo.MongoClient()
+        redis, worker_redis = StrictRedis(db=15), StrictRedis(db=14)
+    db = mongo.twitter_replay
+
+    stages = configure(db, redis, worker_redis, load_keywords(args.wordlist), args.frog_delay)
+
+    messages = read_messages(args.recording, args.limit)
+    ids, deleted = status_ids(messages)
+    if not ids:
+        sys.exit("No statuses in {}".format(args.recording))
+    expected = ids - deleted  # the deleted tweets shouldn't be in the database
+    statuses = sum(1 for m in messages if "delete" not in json.loads(m))
+    ok = True
+    for batch_size in args.batch_size:
+        log_dir = mkdtemp(prefix="replay-") if args.ingest_log else None
+        reset(mongo, redis, worker_redis, log_dir)
+        stages.seconds.clear()
+        seconds = replay(messages, batch_size)
+
+        stored = stored_ids(db)
+        tagged = sum(c.count_documents({"num_keywords": {"$gt": 0}}) for c in partitions.collections(db))
+        staged = num_staged(redis)
+        if log_dir:
+            shutil.rmtree(log_dir)
+        print("batch size {}: {:8.0f} tweets/s ({:.2f} s), inserted {} of {} tweets, {} with keywords".format(
+            batch_size, statuses / seconds, seconds, len(stored), len(expected), tagged))
+        for (_, name, level) in STAGES:
+            s = stages.seconds[name]
+            print("    {:<22} {:10.1f} µs/tweet {:5.1f}%".format(
+                "  " * level + name, s / statuses * 1E6, 100 * s / seconds))
+        counters = {k.decode(): int(v) for (k, v) in redis.hgetall(metrics.COUNTERS).items()}
+        print("    deletes: {} notices, {} deleted, {} purged from staging".format(
+            counters.get("delete_notices", 0), counters.get("deleted", 0), counters.get("purged", 0)))
+        lookups = {k.decode(): int(v) for (k, v) in redis.hgetall(metrics.FROG_CACHE).items()}
+        print("    frog cache: {}".format(", ".join(
+            "{} {}".format(result, lookups.get(result, 0)) for result in metrics.FROG_CACHE_RESULTS)))
+        sample = {k.decode(): int(v) for (k, v) in redis.hgetall(metrics.PREFILTER).items()}
+        print("    prefilter sample: {} sampled, {} with keywords".format(
+            sample.get("sampled", 0), sample.get("missed", 0)))
+        if stored != expected or staged:
+            print("    error: {} tweets weren't inserted, {} deleted tweets were, {} are still staged".format(
+                len(expected - stored), len(stored & deleted), staged))
+            ok = False
+
+    reset(mongo, redis, worker_redis)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Hourly keyword counts, maintained at insert time so the API doesn't have to
+count raw tweets.
+
+A rollup document counts the tweets with a keyword in one hour:
+
+    {"keyword": "tulp", "group": None, "hour": datetime(...), "tweets": 12, "spam": 1}
+
+For every keyword of a tweet there is one document with `group` None and one
+for every group of the tweet. The groups are those of the whole tweet, so a
+keyword is also counted in the groups of the other keywords in that tweet:
+filter on the groups of the keyword when reading a group.
+
+Backfill rollups for tweets inserted before the rollups existed with:
+
+    python rollups.py --start 2017-01-01T00:00:00 --end 2018-01-01T00:00:00
+"""
+import argparse
+from collections import OrderedDict, defaultdict
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+from functools import reduce
+from math import gcd
+from os.path import dirname
+
+from pymongo import ReplaceOne, UpdateOne
+
+from hortiradar import time_format
+from hortiradar.database import get_db
+from hortiradar.database.partitions import aggregate
+
+
+config = ConfigParser()
+config.read(dirname(__file__) + "/../clustering/config.ini")
+spam_level = config.getfloat("database:parameters", "spam_level")
+
+HOUR = timedelta(hours=1)
+EPOCH = datetime(1970, 1, 1)
+
+
+def is_spam(score):
+    return score is not None and score > spam_level
+
+
+def floor_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(dt):
+    hour = floor_hour(dt)
+    return hour if hour == dt else hour + HOUR
+
+
+def step_bases(steps):
+    """Groups the steps of time series that are counted in one pass, as a list
+    of (base, steps) where the bins of base divide those of the steps. The
+    steps of whole hours are counted in bins of their greatest common divisor,
+    which are whole hours too so they come from the rollups. Every other step
+    is counted on its own: with the hours their divisor could be seconds."""
+    hours = [dt for dt in steps if dt % HOUR == timedelta(0)]
+    bases = []
+    if hours:
+        bases.append((timedelta(seconds=reduce(gcd, [int(dt.total_seconds()) for dt in hours])), hours))
+    for dt in OrderedDict.fromkeys(dt for dt in steps if dt % HOUR):
+        bases.append((dt, [dt]))
+    return bases
+
+
+def floor_expr(field, step_ms):
+    """Aggregation expression that rounds the datetime `field` down to a
+    multiple of `step_ms` milliseconds since the epoch."""
+    return {"$subtract": [field, {"$mod": [{"$subtract": [field, EPOCH]}, step_ms]}]}
+
+
+def bin_expr(field, start, step_ms):
+    """Aggregation expression for the number of the bin of `step_ms` milliseconds
+    that the datetime `field` falls in, where bin 0 starts at `start`."""
+    offset = {"$subtract": [field, start]}
+    return {"$divide": [{"$subtract": [offset, {"$mod": [offset, step_ms]}]}, step_ms]}
+
+
+def rollup_counts(tweets, sign=1):
+    """Counts per (keyword, group, hour) of the tweet documents. Use a `sign` of
+    -1 for deleted tweets."""
+    counts = defaultdict(lambda: [0, 0])
+    for t in tweets:
+        hour = floor_hour(t["datetime"])
+        spam = int(is_spam(t.get("spam")))
+        for kw in t["keywords"]:
+            for group in [None] + t["groups"]:
+                c = counts[(kw, group, hour)]
+                c[0] += sign
+                c[1] += sign * spam
+    return counts
+
+
+def rollup_updates(counts):
+    return [
+        UpdateOne({"keyword": kw, "group": group, "hour": hour}, {"$inc": {"tweets": n, "spam": s}}, upsert=True)
+        for ((kw, group, hour), (n, s)) in counts.items() if n or s
+    ]
+
+
+def update_rollups(rollups, tweets, sign=1):
+    """Add (or with `sign` -1 remove) the tweet documents to the rollups."""
+    updates = rollup_updates(rollup_counts(tweets, sign))
+    if updates:
+        rollups.bulk_write(updates, ordered=False)
+
+
+def update_rollups_spam(rollups, changes):
+    """Move tweets between the spam and non-spam counts, `changes` are the
+    (tweet, old_spam, new_spam) of the tweets whose spam score changed."""
+    deltas = defaultdict(int)
+    for (tweet, old_spam, new_spam) in changes:
+        delta = int(is_spam(new_spam)) - int(is_spam(old_spam))
+        if delta:
+            for k in rollup_counts([tweet]):
+                deltas[k] += delta
+    updates = rollup_updates({k: (0, d) for (k, d) in deltas.items()})
+    if updates:
+        rollups.bulk_write(updates, ordered=False)
+
+
+def read_keyword_counts(rollups, start, end, group=None):
+    """Tweet counts per keyword in the whole hours from start to end."""
+    cursor = rollups.aggregate([
+        {"$match": {"group": group, "hour": {"$gte": start, "$lt": end}}},
+        {"$group": {"_id": "$keyword", "count": {"$sum": "$tweets"}}},
+    ])
+    return {r["_id"]: r["count"] for r in cursor}
+
+
+def read_bins(rollups, keywords, start, end, step_ms):
+    """Yields (keyword, bin, tweets, spam) for the keywords in the whole hours
+    from start to end, in bins of `step_ms` (a multiple of an hour) from start."""
+    cursor = rollups.aggregate([
+        {"$match": {"keyword": {"$in": keywords}, "group": None, "hour": {"$gte": start, "$lt": end}}},
+        {"$group": {
+            "_id": {"keyword": "$keyword", "bin": bin_expr("$hour", start, step_ms)},
+            "tweets": {"$sum": "$tweets"}, "spam": {"$sum": "$spam"},
+        }},
+    ])
+    for r in cursor:
+        yield r["_id"]["keyword"], int(r["_id"]["bin"]), r["tweets"], r["spam"]
+
+
+def backfill(db, start, end, keywords=None):
+    """Recount the rollups from the tweets in the whole hours from start to end,
+    of all keywords or only of `keywords`."""
+    start, end = floor_hour(start), ceil_hour(end)
+    hours = {"hour": {"$gte": start, "$lt": end}}
+    match = {"num_keywords": {"$gt": 0}, "datetime": {"$gte": start, "$lt": end}}
+    unwind = [{"$unwind": "$keywords"}]
+    if keywords is not None:
+        hours["keyword"] = {"$in": keywords}
+        match["keywords"] = {"$in": keywords}
+        unwind.append({"$match": {"keywords": {"$in": keywords}}})
+    db.rollups.delete_many(hours)
+    project = {
+        "keywords": True, "groups": True,
+        "hour": floor_expr("$datetime", 60 * 60 * 1000),
+        "spam": {"$cond": [{"$gt": ["$spam", spam_level]}, 1, 0]},
+    }
+    count = {"tweets": {"$sum": 1}, "spam": {"$sum": "$spam"}}
+    pipelines = [
+        [{"$match": match}, {"$project": project}] + unwind +
+        [{"$group": dict(_id={"keyword": "$keywords", "group": None, "hour": "$hour"}, **count)}],
+        [{"$match": match}, {"$project": project}] + unwind + [{"$unwind": "$groups"},
+         {"$group": dict(_id={"keyword": "$keywords", "group": "$groups", "hour": "$hour"}, **count)}],
+    ]
+    for pipeline in pipelines:
+        updates = []
+        for r in aggregate(db, pipeline):
+            doc = dict(r["_id"], tweets=r["tweets"], spam=r["spam"])
+            updates.append(ReplaceOne(r["_id"], doc, upsert=True))
+            if len(updates) == 1000:
+                db.rollups.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            db.rollups.bulk_write(updates, ordered=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the keyword rollups from the tweets.")
+    parser.add_argument("--start", required=True, help="start datetime: %s" % time_format.replace("%", "%%"))
+    parser.add_argument("--end", required=True, help="end datetime: %s" % time_format.replace("%", "%%"))
+    args = parser.parse_args()
+
+    db = get_db()
+    start = datetime.strptime(args.start, time_format)
+    end = datetime.strptime(args.end, time_format)
+    # one day at a time to keep the aggregations small
+    day = start
+    while day < end:
+        backfill(db, day, min(day + timedelta(days=1), end))
+        day += timedelta(days=1)
+
+
+if __name__ == "__main__":
+    main()
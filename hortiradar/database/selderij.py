@@ -1,6 +1,11 @@
 from os import environ
 
 from celery import Celery
+from kombu import Queue
+from kombu.common import Broadcast
+from kombu.serialization import register
+
+from hortiradar.database import payloads
 
 
 if environ.get("ROLE") == "worker":
@@ -13,6 +18,13 @@ else:
 
 app = Celery("tasks", broker=broker_url)
 app.conf.update(task_ignore_result=True, worker_prefetch_multiplier=20)
+# the workers send the results to the master with the compact serializer, all
+# processes accept it next to JSON so old and new workers can run together
+register(payloads.NAME, payloads.dumps, payloads.loads,
+         content_type=payloads.CONTENT_TYPE, content_encoding="binary")
+app.conf.accept_content = ["json", payloads.NAME]
+# every worker consuming the broadcast queue gets its own copy of the messages
+app.conf.task_queues = (Queue("master"), Queue("workers"), Broadcast("broadcast"))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+"""Spam scores of the tweets, given by the master when it inserts them. A tweet
+with a score above `spam_level` is spam and the API leaves it out, tweets
+without signs of spam don't get a `spam` field.
+
+The signals are cheap checks on the tweet and its tokens: obscene words in its
+lemmas or words, the `possibly_sensitive` flag of Twitter and hashtag
+stuffing. Score the tweets that were inserted before the master scored them
+with:
+
+    python spam.py --start 2017-01-01T00:00:00 --end 2018-01-01T00:00:00
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from hortiradar import time_format
+from hortiradar.database import api_cache, get_db, obscene_words
+from hortiradar.database.partitions import collection_for, find
+from hortiradar.database.rollups import is_spam, update_rollups_spam
+
+
+OBSCENE = 0.8    # also the score of the images the website finds not safe for work
+SENSITIVE = 0.7
+HASHTAGS = 0.7
+MAX_HASHTAGS = 10
+
+# backfill writes the scores and the rollups per this many scored tweets
+batch_size = 1000
+
+
+def spam_score(tweet, tokens):
+    """The spam score of the tweet JSON with its tokens, None for no spam."""
+    score = None
+    if any(obscene_words.get(t["lemma"]) or obscene_words.get(t["text"].lower()) for t in tokens):
+        score = OBSCENE
+    elif tweet.get("possibly_sensitive", False):
+        score = SENSITIVE
+    elif len(tweet.get("entities", {}).get("hashtags", [])) > MAX_HASHTAGS:
+        score = HASHTAGS
+    return score
+
+
+def backfill(db, start, end):
+    """Score the tweets from start to end that don't have a spam score."""
+    query = {"datetime": {"$gte": start, "$lt": end}, "spam": {"$exists": False}}
+    projection = {"tweet.possibly_sensitive": True, "tweet.entities.hashtags": True, "tokens": True,
+                  "keywords": True, "num_keywords": True, "groups": True, "datetime": True}
+    scored = []
+    for t in find(db, query, projection=projection):
+        score = spam_score(t["tweet"], t["tokens"])
+        if score is None:
+            continue
+        scored.append((t, score))
+        if len(scored) == batch_size:
+            write_scores(db, scored)
+            scored = []
+    write_scores(db, scored)
+
+
+def write_scores(db, scored):
+    """Write the (tweet, score) of a batch of tweets without a score before,
+    and move the spam among them in the rollups."""
+    updates = {}
+    for (t, score) in scored:
+        collection = collection_for(db, t["datetime"])
+        updates.setdefault(collection.name, []).append(UpdateOne({"_id": t["_id"]}, {"$set": {"spam": score}}))
+    for (name, ops) in updates.items():
+        db[name].bulk_write(ops, ordered=False)
+    changes = [(t, None, score) for (t, score) in scored if t["keywords"] and is_spam(score)]
+    update_rollups_spam(db.rollups, changes)
+    if changes:
+        api_cache.invalidate({kw for (t, _, _) in changes for kw in t["keywords"]},
+                             {g for (t, _, _) in changes for g in t["groups"]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score the spam of the tweets that don't have a score.")
+    parser.add_argument("--start", required=True, help="start datetime: %s" % time_format.replace("%", "%%"))
+    parser.add_argument("--end", required=True, help="end datetime: %s" % time_format.replace("%", "%%"))
+    args = parser.parse_args()
+
+    db = get_db()
+    start = datetime.strptime(args.start, time_format)
+    end = datetime.strptime(args.end, time_format)
+    # one day at a time to keep the updates small
+    day = start
+    while day < end:
+        backfill(db, day, min(day + timedelta(days=1), end))
+        day += timedelta(days=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,131 @@
-import ujson as json
+"""Statistics of the database for the about page, kept up to date in redis.
+
+The master counts the tweets it inserts: per day the number of tweets and of
+tweets with keywords, per hour for the count of the last 24 hours, the total
+and the first and last tweet time. Running this script reconciles the counters
+of the days before today with the database after tweets were deleted (clean.py,
+archive.py), and measures the size of the database. It corrects the counters by
+the difference with the counts, so the master can keep counting meanwhile:
+
+    python statistics.py
+"""
+from datetime import datetime, timedelta
+
 from redis import StrictRedis
 
-from keywords import get_db
+from hortiradar.database import get_db
+from hortiradar.database.partitions import collections
+
 
+COUNT = "stats:count"
+FIRST = "stats:first"
+LAST = "stats:last"
+SIZE = "stats:size"
+DAY = "stats:day:{:%Y-%m-%d}"  # hash with the tweets and tagged counts
+HOUR = "stats:hour:{:%Y-%m-%dT%H}"
+HOUR_TIME = 60 * 60 * 26
 
-db = get_db()
-redis = StrictRedis()
+stats_time_format = "%Y-%m-%dT%H:%M:%S"
 
 format_count = lambda c: "{:,}".format(c)  # use , for thousands separator
-clean_count = lambda c: int(c.replace(",", ""))
-
-stats = db.command("collstats", "tweets", scale=int(1E9))
-count = stats["count"]               # number of tweets
-size = stats["size"]                 # raw collection size
-storage_size = stats["storageSize"]  # compressed collection size
-
-oldest_tweet = db.tweets.find({"num_keywords": 0}).sort("datetime", 1).limit(1)[0]
-latest_tweet = db.tweets.find({"num_keywords": 0}).sort("datetime", -1).limit(1)[0]
-oldest_date = oldest_tweet["datetime"].strftime("%Y-%m-%d")
-latest_date = latest_tweet["datetime"].strftime("%Y-%m-%d")
-
-try:
-    prev_stats = json.loads(redis.get("t:stats"))
-    prev_count = clean_count(prev_stats["count"])
-except TypeError:
-    prev_count = 0
-count_24h = count - prev_count  # number of tweets in the last 24h
-
-stats = {
-    "count": format_count(count),
-    "count_24h": format_count(count_24h),
-    "size": size,
-    "storage_size": storage_size,
-    "date_oldest_tweet": oldest_date,
-    "date_latest_tweet": latest_date
-}
-redis.set("t:stats", json.dumps(stats))
+
+
+def count_tweets(redis, tweets, sign=1):
+    """Count the inserted (or with `sign` -1 deleted) tweet documents."""
+    if not tweets:
+        return
+    pipe = redis.pipeline()
+    pipe.incrby(COUNT, sign * len(tweets))
+    for t in tweets:
+        dt = t["datetime"]
+        pipe.hincrby(DAY.format(dt), "tweets", sign)
+        if t["num_keywords"]:
+            pipe.hincrby(DAY.format(dt), "tagged", sign)
+        pipe.incrby(HOUR.format(dt), sign)
+        pipe.expire(HOUR.format(dt), HOUR_TIME)
+    if sign > 0:
+        pipe.set(FIRST, min(t["datetime"] for t in tweets).strftime(stats_time_format), nx=True)
+    pipe.execute()
+    if sign > 0:
+        last = max(t["datetime"] for t in tweets).strftime(stats_time_format)
+        # only the master inserts tweets, so there's no race between get and set
+        current = redis.get(LAST)
+        if current is None or current.decode("ascii") < last:
+            redis.set(LAST, last)
+
+
+def read_stats(redis):
+    """The statistics for the about page."""
+    now = datetime.utcnow()
+    hours = [HOUR.format(now - timedelta(hours=h)) for h in range(24)]
+    count, first, last = redis.mget(COUNT, FIRST, LAST)
+    size = redis.hgetall(SIZE)
+    date = lambda d: d.decode("ascii")[:10] if d else ""  # only the date of the time
+    return {
+        "count": format_count(int(count or 0)),
+        "count_24h": format_count(sum(int(c) for c in redis.mget(hours) if c)),
+        "size": int(size.get(b"size", 0)),
+        "storage_size": int(size.get(b"storage_size", 0)),
+        "date_oldest_tweet": date(first),
+        "date_latest_tweet": date(last),
+    }
+
+
+def reconcile(db, redis):
+    """Recount the daily counters of the days before today, the total and the
+    first tweet from the database, and measure its size."""
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    days = {}
+    for c in collections(db, end=today):
+        cursor = c.aggregate([
+            {"$match": {"datetime": {"$lt": today}}},
+            {"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$datetime"}},
+                "tweets": {"$sum": 1},
+                "tagged": {"$sum": {"$cond": [{"$gt": ["$num_keywords", 0]}, 1, 0]}},
+                "first": {"$min": "$datetime"},
+                "last": {"$max": "$datetime"},
+            }},
+        ], allowDiskUse=True)
+        for r in cursor:
+            day = days.setdefault(r["_id"], {"tweets": 0, "tagged": 0, "first": r["first"], "last": r["last"]})
+            day["tweets"] += r["tweets"]
+            day["tagged"] += r["tagged"]
+            day["first"] = min(day["first"], r["first"])
+            day["last"] = max(day["last"], r["last"])
+
+    size = storage_size = 0
+    for c in collections(db):
+        stats = db.command("collstats", c.name, scale=int(1E9))
+        size += stats["size"]                 # raw collection size
+        storage_size += stats["storageSize"]  # compressed collection size
+
+    # the counters after the counts, read at once (in a transaction): the
+    # master's increments since then are kept by applying the differences
+    past = {DAY.format(datetime.strptime(d, "%Y-%m-%d")) for d in days}
+    past.update(k.decode("ascii") for k in redis.scan_iter("stats:day:*"))
+    past = sorted(k for k in past if k < DAY.format(today))
+    pipe = redis.pipeline()
+    for key in past:
+        pipe.hmget(key, "tweets", "tagged")
+    pipe.hget(DAY.format(today), "tweets")
+    pipe.get(COUNT)
+    *snapshot, today_count, count = pipe.execute()
+
+    pipe = redis.pipeline()
+    total = int(today_count or 0)
+    for (key, (tweets, tagged)) in zip(past, snapshot):
+        day = days.get(key[len("stats:day:"):], {"tweets": 0, "tagged": 0})
+        pipe.hincrby(key, "tweets", day["tweets"] - int(tweets or 0))
+        pipe.hincrby(key, "tagged", day["tagged"] - int(tagged or 0))
+        total += day["tweets"]
+    pipe.incrby(COUNT, total - int(count or 0))
+    if days:
+        pipe.set(FIRST, min(day["first"] for day in days.values()).strftime(stats_time_format))
+        pipe.set(LAST, max(day["last"] for day in days.values()).strftime(stats_time_format), nx=True)
+    pipe.hmset(SIZE, {"size": size, "storage_size": storage_size})
+    pipe.execute()
+
+
+if __name__ == "__main__":
+    reconcile(get_db(), StrictRedis())
@@ -1,5 +1,6 @@
 from configparser import ConfigParser
-from time import sleep
+from threading import Lock, Thread
+from time import sleep, time
 import traceback
 
 import tweepy
@@ -9,7 +10,10 @@ from redis import StrictRedis
 from requests import ConnectionError, Timeout
 from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
 
-from tasks_workers import find_keywords_and_groups
+from hortiradar.database import delete_tweets
+import ingest_log
+from metrics import count_received, count_staged
+from tasks_workers import find_keywords_and_groups, find_keywords_and_groups_batch
 
 
 RotatingFileHandler("twitter.log", backup_count=5).push_application()
@@ -19,30 +23,112 @@ log.info("Started")
 redis = StrictRedis()
 
 
+class Batcher:
+    """Collects items and passes them on to `flush` in batches of `size` items.
+    Every `interval` seconds the items collected so far are flushed, so items
+    don't wait long when it's quiet.
+    """
+    def __init__(self, flush, size, interval):
+        self.flush = flush
+        self.size = size
+        self.interval = interval
+        self.items = []
+        self.lock = Lock()
+        Thread(target=self.run, daemon=True).start()
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+            if len(self.items) < self.size:
+                return
+            items, self.items = self.items, []
+        self.flush(items)
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            with self.lock:
+                items, self.items = self.items, []
+            if items:
+                try:
+                    self.flush(items)
+                except Exception:
+                    log.critical(traceback.format_exc())
+
+
+def send_to_workers(items):
+    """Send the (id_str, text, retweet_id_str, received, ref) items to the workers."""
+    tweets = [item[:3] for item in items]
+    kwargs = {"stamps": {"received": [item[3] for item in items]}}
+    refs = {item[0]: item[4] for item in items if item[4] is not None}
+    if refs:
+        kwargs["refs"] = refs
+    count_received(redis, len(items))
+    find_keywords_and_groups_batch.apply_async((tweets,), kwargs, queue="workers")
+
+
+def send_deletes(id_strs):
+    """Send the ids of a batch of deleted tweets to the master."""
+    delete_tweets.apply_async((id_strs,), queue="master")
+
+
 class StreamListener(tweepy.StreamListener):
     """Tweepy will continuously receive notices from Twitter and dispatches
     them to one of the event handlers.
+
+    With a `batch_size` larger than 1, the tweets are sent to the workers in
+    batches of that many tweets, or of the tweets received in the last
+    `batch_interval` seconds.
+
+    The tweets are staged for the master in redis, or with `ingest_log` enabled
+    in the ingest log.
+
+    Delete notices are sent to the master in batches of `delete_batch_size`
+    tweets or every `delete_interval` seconds.
     """
-    def __init__(self, api):
+    def __init__(self, api, batch_size=1, batch_interval=1.0, delete_batch_size=1000, delete_interval=10.0):
         self.api = api
+        self.log = ingest_log.Writer() if ingest_log.enabled else None
+        self.deletes = Batcher(send_deletes, delete_batch_size, delete_interval)
+        if batch_size > 1:
+            self.batcher = Batcher(send_to_workers, batch_size, batch_interval)
+        else:
+            self.batcher = None
 
     def on_status(self, status):
         """Handle arrival of a new tweet."""
+        received = time()
         j = filter_tweet(clean_tweet(status._json))
-        redis.set("t:" + j["id_str"], json.dumps(j))
+        ref = self.stage(j)
         if "retweeted_status" in j:
             retweet_id_str = j["retweeted_status"]["id_str"]
         else:
             retweet_id_str = None
-        find_keywords_and_groups.apply_async((j["id_str"], j["text"], retweet_id_str), queue="workers")
+        if self.batcher:
+            self.batcher.add((j["id_str"], j["text"], retweet_id_str, received, ref))
+        else:
+            kwargs = {"stamps": {"received": [received]}}
+            if ref is not None:
+                kwargs["refs"] = {j["id_str"]: ref}
+            count_received(redis)
+            find_keywords_and_groups.apply_async((j["id_str"], j["text"], retweet_id_str), kwargs, queue="workers")
+
+    def stage(self, j):
+        """Stage the tweet for the master. Returns its sequence number in the
+        ingest log, or None when it's staged in redis."""
+        data = json.dumps(j)
+        if self.log:
+            return self.log.append(data.encode("utf-8"))
+        # a tweet that Twitter sent again while it's still staged is counted once
+        if redis.set("t:" + j["id_str"], data, nx=True):
+            count_staged(redis)
+        return None
 
     def on_delete(self, status_id, user_id):
         """A user deleted a tweet, respect their decision by also deleting it
         on our end.
         """
-        status_id, user_id = str(status_id), str(user_id)
-        log.notice("on_delete: status_id = {}, user_id = {}".format(status_id, user_id))
-        self.tweets.delete_one({"tweet.id_str": status_id})
+        self.deletes.add(str(status_id))
 
     def on_error(self, status_code):
         """This does the Twitter-recommended exponential backoff when it
@@ -162,13 +248,15 @@ def filter_tweet(j):
 def main():
     config = ConfigParser()
     config.read("streamer.ini")
+    batch_size = config.getint("streamer", "batch_size", fallback=1)
+    batch_interval = config.getfloat("streamer", "batch_interval", fallback=1.0)
     config = config["twitter"]
 
     auth = tweepy.OAuthHandler(config["consumer_key"], config["consumer_secret"])
     auth.set_access_token(config["access_key"], config["access_secret"])
     api = tweepy.API(auth, compression=True, wait_on_rate_limit=True)
 
-    listener = StreamListener(api)
+    listener = StreamListener(api, batch_size, batch_interval)
     stream = tweepy.Stream(auth=auth, listener=listener)
 
     with open("data/stoplist_nl_extended.txt") as f:
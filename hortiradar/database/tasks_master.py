@@ -1,10 +1,18 @@
+from collections import OrderedDict
 from datetime import datetime
+from time import time
 from typing import Sequence
 
 import ujson as json
+from celery_batches import Batches
+from pymongo.errors import BulkWriteError
 from redis import StrictRedis
 
-from hortiradar.database import app, get_db
+from hortiradar.database import api_cache, app, get_db, ingest_log
+from hortiradar.database.metrics import count_deletes, record_insert
+from hortiradar.database.partitions import collection_for_id, split
+from hortiradar.database.rollups import HOUR, backfill, floor_hour, update_rollups
+from hortiradar.database.statistics import count_tweets
 
 
 redis = StrictRedis()
@@ -13,28 +21,167 @@ db = get_db()
 # the "created_at" field, example: 'Tue Jun 28 15:01:54 +0000 2016'
 tweet_time_format = "%a %b %d %H:%M:%S +0000 %Y"
 
+# insert_tweet collects up to batch_size tweets or waits at most batch_time seconds
+batch_size = 100
+batch_time = 0.5
+
+# deleted tweets staged in redis are purged, the tombstone only covers the
+# inserts already in progress. The ingest log keeps its own tombstones as long
+# as the tweets can be in the log.
+TOMBSTONE_TIME = 60 * 60
+
+# the fields of a tweet document that are counted in the rollups and the statistics
+rollup_projection = {"keywords": True, "num_keywords": True, "groups": True, "datetime": True, "spam": True}
+
+@app.task(base=Batches, flush_every=batch_size, flush_interval=batch_time)
+def insert_tweet(requests):
+    """Task to insert tweets into MongoDB. Called per tweet with the arguments
+    (id_str, keywords, groups, tokens), but executed in batches.
+    """
+    refs = {}
+    for r in requests:
+        refs.update(r.kwargs.get("refs") or {})
+    insert_tweets([r.args for r in requests], [r.kwargs.get("stamps") for r in requests], refs)
+
+
 @app.task
-def insert_tweet(id_str, keywords, groups, tokens):
-    """Task to insert tweet into MongoDB."""
-    key = "t:" + id_str
-    data = redis.get(key)
-    if data is None:
-        # the tweet was already inserted
+def insert_tweet_batch(items, stamps=None, refs=None):
+    """Task to insert a batch of tweets analyzed together by a worker."""
+    insert_tweets(items, [stamps], refs)
+
+
+def load_staged(ids, refs):
+    """The (id_str, tweet JSON) of the tweets that weren't inserted yet, from
+    the ingest log for the tweets with `refs` (their sequence numbers) and
+    from redis for the others, and the ids of the tweets that are skipped
+    because they were deleted."""
+    # skip the tweets deleted by their users before they were inserted
+    deleted = {id_str for (id_str, d) in zip(ids, redis.mget(["d:" + id_str for id_str in ids])) if d}
+    deleted |= ingest_log.tombstoned(redis, [id_str for id_str in ids if id_str in refs])
+    ingest_log.mark_done(redis, [refs[id_str] for id_str in deleted if id_str in refs])
+    ids = [id_str for id_str in ids if id_str not in deleted]
+    logged = [id_str for id_str in ids if id_str in refs]
+    staged = [id_str for id_str in ids if id_str not in refs]
+    loaded = []
+    if logged:
+        loaded += zip(logged, ingest_log.read_new(redis, [refs[id_str] for id_str in logged]))
+    if staged:
+        loaded += zip(staged, redis.mget(["t:" + id_str for id_str in staged]))
+    # the tweets without data were already inserted
+    return [(id_str, data) for (id_str, data) in loaded if data is not None], deleted
+
+
+def insert_tweets(items, stamps=(), refs=None):
+    """Insert the tweets with the (id_str, keywords, groups, tokens) from the
+    workers, the tweets themselves are in redis or the ingest log. The
+    `stamps` of the tasks are recorded in the ingest metrics."""
+    # spam.py imports the word lists of the package, which imports this module
+    from hortiradar.database.spam import spam_score
+
+    master_start = time()
+    refs = refs or {}
+    results = {}
+    for (id_str, keywords, groups, tokens) in items:
+        results[id_str] = (keywords, groups, tokens)
+    if not results:
         return
-    j = json.loads(data)
-    tweet = {
-        "tweet": j,
-        "keywords": keywords,
-        "num_keywords": len(keywords),
-        "groups": groups,
-        "tokens": tokens,
-        "datetime": datetime.strptime(j["created_at"], tweet_time_format),
-    }
-    spam = j.get("possibly_sensitive", False)
-    if spam:
-        tweet["spam"] = 0.7
-    db.tweets.insert_one(tweet)
-    redis.delete(key)
+    tweets = []
+    inserted = []
+    loaded, deleted = load_staged(list(results), refs)
+    for (id_str, data) in loaded:
+        j = json.loads(data)
+        keywords, groups, tokens = results[id_str]
+        tweet = {
+            "tweet": j,
+            "keywords": keywords,
+            "num_keywords": len(keywords),
+            "groups": groups,
+            "tokens": tokens,
+            "datetime": datetime.strptime(j["created_at"], tweet_time_format),
+        }
+        spam = spam_score(j, tokens)
+        if spam is not None:
+            tweet["spam"] = spam
+        tweets.append(tweet)
+        inserted.append(id_str)
+    new_tweets = []
+    for (collection, part) in split(db, tweets):
+        new_tweets += insert_new(collection, part)
+    update_rollups(db.rollups, [t for t in new_tweets if t["keywords"]])
+    count_tweets(redis, new_tweets)
+    # the API caches the counts of ranges that ended FINAL_AGE ago, late tweets change them
+    cutoff = datetime.utcnow() - api_cache.FINAL_AGE
+    late = [t for t in new_tweets if t["keywords"] and t["datetime"] < cutoff]
+    if late:
+        api_cache.invalidate({kw for t in late for kw in t["keywords"]}, {g for t in late for g in t["groups"]})
+    keys = ["t:" + id_str for id_str in inserted + list(deleted) if id_str not in refs]
+    unstaged = redis.delete(*keys) if keys else 0
+    ingest_log.mark_done(redis, [refs[id_str] for id_str in inserted if id_str in refs])
+    record_insert(redis, stamps, master_start, len(new_tweets), unstaged)
+
+
+@app.task
+def delete_tweets(id_strs):
+    """Task to delete the tweets that their users deleted, with the ids of a
+    batch of delete notices from the streamer. Tweets that weren't inserted
+    yet are removed from staging and get a tombstone so they're skipped."""
+    parts = OrderedDict()
+    for id_str in id_strs:
+        parts.setdefault(collection_for_id(db, id_str).name, []).append(id_str)
+    tweets = []
+    uncertain = []
+    for (name, ids) in parts.items():
+        found = list(db[name].find({"tweet.id_str": {"$in": ids}}, projection=rollup_projection))
+        if not found:
+            continue
+        # by _id: the tweets inserted in the meantime aren't deleted
+        deleted = db[name].delete_many({"_id": {"$in": [t["_id"] for t in found]}}).deleted_count
+        if deleted == len(found):
+            tweets += found
+        elif deleted:
+            # others were deleted at the same time by the API or another task,
+            # which counted those: it's unknown which ones this task removed
+            uncertain += found[:deleted]
+    update_rollups(db.rollups, [t for t in tweets if t["keywords"]], sign=-1)
+    recount_rollups(uncertain)
+    # statistics.py corrects the statistics of the uncertain tweets
+    tweets += uncertain
+    count_tweets(redis, tweets, sign=-1)
+
+    pipe = redis.pipeline()
+    for id_str in id_strs:
+        pipe.delete("t:" + id_str)
+        pipe.set("d:" + id_str, 1, ex=TOMBSTONE_TIME)
+    purged = sum(pipe.execute()[::2])
+    if ingest_log.enabled:
+        ingest_log.add_tombstones(redis, id_strs)
+    count_deletes(redis, len(id_strs), len(tweets), purged)
+
+    keywords = {kw for t in tweets for kw in t["keywords"]}
+    if keywords:
+        api_cache.invalidate(keywords, {g for t in tweets for g in t["groups"]})
+
+
+def recount_rollups(tweets):
+    """Recount the rollups of the keywords of the deleted tweets in their hours
+    from the database."""
+    for hour in {floor_hour(t["datetime"]) for t in tweets}:
+        keywords = sorted({kw for t in tweets if floor_hour(t["datetime"]) == hour for kw in t["keywords"]})
+        if keywords:
+            backfill(db, hour, hour + HOUR, keywords)
+
+
+def insert_new(collection, tweets):
+    """Insert the tweets, returns those that weren't already in the collection."""
+    try:
+        collection.insert_many(tweets, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(err["code"] != 11000 for err in errors):  # 11000: duplicate key
+            raise
+        duplicates = {err["index"] for err in errors}
+        tweets = [t for (i, t) in enumerate(tweets) if i not in duplicates]
+    return tweets
 
 
 @app.task
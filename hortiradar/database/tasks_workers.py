@@ -1,50 +1,325 @@
 import os
+import re
+import unicodedata
+from collections import Counter, OrderedDict
 from configparser import ConfigParser
+from hashlib import blake2b
+from random import random
 from time import time
 from typing import Sequence
 
+import ahocorasick
 from redis import StrictRedis
 import ujson as json
 
-from hortiradar.database import app, get_frog, get_keywords, insert_tweet, insert_lemma
+from hortiradar.database import app, get_frog, get_keywords, insert_lemma, insert_tweet, insert_tweet_batch
+from hortiradar.database.keywords import fetch_keywords_version
 
 
-if os.environ.get("ROLE") == "worker":
-    keywords = get_keywords()
-    keywords_sync_time = time()
+# seconds between the checks for a newer version of the keyword registry than
+# the broadcasts told, a worker misses them while it's disconnected
+KEYWORDS_CHECK_TIME = 10 * 60
+# seconds between the rebuilds of the prefilter with the inflections it learned
+PREFILTER_BUILD_TIME = 60 * 60
 
+# the workers run this module as `celery -A tasks_workers`, so their tasks are
+# named after it. The package imports it again as hortiradar.database.tasks_workers,
+# a separate copy that doesn't load the keywords: send tasks by these names.
+WORKER_MODULE = "tasks_workers"
+KEYWORDS_CHANGED_TASK = WORKER_MODULE + ".keywords_changed"
+
+# the version of the registry of the loaded keywords, None in a copy without them
+keywords_version = None
+
+
+def surface_forms(lemma):
+    """Strings of which at least one is in the lowercased text of a tweet
+    containing the keyword. The prefilter looks for substrings, so inflections
+    that start with the lemma are found with the lemma, such as "bloem" in
+    "bloemen" and "bloemetje". Others need a stem with the Dutch spelling
+    rules for plurals: "roos" -> "roz" for "rozen" and "druif" -> "druiv" for
+    "druiven".
+    """
+    lemma = lemma.lower().replace("_", " ")  # frog joins multi-word units with _
+    forms = {lemma}
+    m = re.match(r"^(.*?)([aeiou])\2([^aeiou])$", lemma)
+    if m:
+        lemma = m.group(1) + m.group(2) + m.group(3)
+        forms.add(lemma)
+    if lemma.endswith("f"):
+        forms.add(lemma[:-1] + "v")
+    elif lemma.endswith("s"):
+        forms.add(lemma[:-1] + "z")
+    return forms
+
+
+def build_prefilter(keywords):
+    """Returns an Aho-Corasick automaton that finds the surface forms of the
+    keywords, including those learned from earlier Frog analyses."""
+    automaton = ahocorasick.Automaton()
+    for lemma in keywords:
+        forms = surface_forms(lemma)
+        forms.update(f.decode("utf-8") for f in redis.smembers("kf:" + lemma))
+        for form in forms:
+            automaton.add_word(form, lemma)
+    automaton.make_automaton()
+    return automaton
+
+
+def refresh_keywords(version=None):
+    """Swap in the keywords at the version of the registry (by default the
+    current one), with a new prefilter."""
+    global keywords_version, keywords, prefilter, keywords_check_time, prefilter_build_time
+    if version is None:
+        version = fetch_keywords_version()  # before the keywords, they can only be newer
+    new_keywords = get_keywords()
+    new_prefilter = build_prefilter(new_keywords)
+    keywords_version, keywords, prefilter = version, new_keywords, new_prefilter
+    keywords_check_time = prefilter_build_time = time()
+
+
+def rebuild_prefilter():
+    """Swap in a prefilter with the inflections learned since the last build."""
+    global prefilter, prefilter_build_time
+    prefilter = build_prefilter(keywords)
+    prefilter_build_time = time()
+
+
+def check_keywords():
+    """Refresh the keywords when the registry has a newer version."""
+    global keywords_check_time
+    keywords_check_time = time()
+    try:
+        version = fetch_keywords_version()
+    except Exception:
+        return  # the API is unreachable, try again at the next check
+    if version > keywords_version:
+        refresh_keywords(version)
+
+
+def may_contain_keyword(text):
+    """False when the text can't contain any of the keywords."""
+    if len(prefilter) == 0:
+        return False
+    for _ in prefilter.iter(text.lower()):
+        return True
+    return False
+
+
+def text_key(text):
+    """Key of the text in the Frog cache: a hash of the text with normalized
+    unicode and whitespace, which don't change Frog's analysis."""
+    text = " ".join(unicodedata.normalize("NFC", text).split())
+    return "f:" + blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class FrogCache:
+    """Frog's tokens of recently analyzed texts, by `text_key`: in an LRU of
+    `size` texts in the worker process, backed by the worker's redis shared by
+    its other processes. Counts the hits in memory, in redis, of texts repeated
+    in the same batch and the misses.
+    """
+    def __init__(self, redis, size, expire):
+        self.redis = redis
+        self.size = size
+        self.expire = expire
+        self.lru = OrderedDict()
+        self.stats = Counter()
+
+    def get_many(self, keys):
+        """The tokens of the cached keys."""
+        found = {}
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[key] = self.lru[key]
+        self.stats["memory"] += len(found)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            for (key, data) in zip(missing, self.redis.mget(missing)):
+                if data is not None:
+                    found[key] = json.loads(data)
+                    self.remember(key, found[key])
+                    self.stats["redis"] += 1
+        self.stats["miss"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Cache the (key, tokens) items."""
+        pipe = self.redis.pipeline()
+        for (key, tokens) in items:
+            self.remember(key, tokens)
+            pipe.set(key, json.dumps(tokens), ex=self.expire)
+        pipe.execute()
+
+    def remember(self, key, tokens):
+        self.lru[key] = tokens
+        if len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def take_stats(self):
+        """The hit counts since the last call."""
+        stats, self.stats = dict(self.stats), Counter()
+        return stats
+
+
+# the tweets of the prefilter sample that Frog analyzed, and those with keywords
+prefilter_stats = Counter()
+
+
+def take_prefilter_stats():
+    """The counts of the prefilter sample since the last call."""
+    global prefilter_stats
+    stats, prefilter_stats = dict(prefilter_stats), Counter()
+    return stats
+
+
+def tokenize(text):
+    """Cheap tokenization for tweets without keywords, giving tokens with the
+    same keys as Frog's, but without a lemma or part-of-speech."""
+    words = re.findall(r"\w+|[^\w\s]+", text)
+    return [{"index": str(i), "text": w, "lemma": w, "pos": "", "posprob": 0.0} for (i, w) in enumerate(words, 1)]
+
+
+if os.environ.get("ROLE") == "worker" and __name__ == WORKER_MODULE:
     config = ConfigParser()
     config.read(os.path.dirname(__file__) + "/tasks_workers.ini")
     posprob_minimum = config["workers"].getfloat("posprob_minimum")
+    frog_cache_size = config["workers"].getint("frog_cache_size", fallback=10000)
+    prefilter_sample = config["workers"].getfloat("prefilter_sample", fallback=0.01)
+    # the serializer of the results for the master: json or hortiradar-msgpack
+    serializer = config["workers"].get("serializer", fallback="json")
 
     redis = StrictRedis()
     rt_cache_time = 60 * 60 * 6
+    frog_cache = FrogCache(redis, frog_cache_size, rt_cache_time)
+
+    refresh_keywords()
+
+
+@app.task
+def keywords_changed(version):
+    """The groups changed, every worker gets this task through the broadcast queue."""
+    if keywords_version is not None and version > keywords_version:
+        refresh_keywords(version)
+
+
+@app.task
+def find_keywords_and_groups(id_str, text, retweet_id_str, stamps=None, refs=None):
+    """Find the keywords and associated groups in the tweet. The `refs` to the
+    tweet in the ingest log are passed on to the master."""
+    worker_start = time()
+    results = analyze_tweets([(id_str, text, retweet_id_str)])
+    stamps = dict(stamps or {}, worker_start=worker_start, worker_done=time(), frog_cache=frog_cache.take_stats(),
+                  prefilter=take_prefilter_stats())
+    for result in results:
+        insert_tweet.apply_async(result, {"stamps": stamps, "refs": refs}, queue="master", serializer=serializer)
 
 
 @app.task
-def find_keywords_and_groups(id_str, text, retweet_id_str):
-    """Find the keywords and associated groups in the tweet."""
-    # refresh keywords
-    global keywords, keywords_sync_time
-    if (time() - keywords_sync_time) > 60 * 60:
-        keywords = get_keywords()
-        keywords_sync_time = time()
+def find_keywords_and_groups_batch(tweets, stamps=None, refs=None):
+    """Find the keywords and associated groups in a list of tweets with
+    (id_str, text, retweet_id_str). Frog analyzes the tweets in one go and the
+    results go to the master in one message.
+    """
+    worker_start = time()
+    results = analyze_tweets(tweets)
+    stamps = dict(stamps or {}, worker_start=worker_start, worker_done=time(), frog_cache=frog_cache.take_stats(),
+                  prefilter=take_prefilter_stats())
+    insert_tweet_batch.apply_async((results,), {"stamps": stamps, "refs": refs}, queue="master",
+                                   serializer=serializer)
+
+
+def analyze_tweets(tweets):
+    """Returns a list with (id_str, keywords, groups, tokens) for the tweets with
+    (id_str, text, retweet_id_str)."""
+    if time() - keywords_check_time > KEYWORDS_CHECK_TIME:
+        check_keywords()
+    if time() - prefilter_build_time > PREFILTER_BUILD_TIME:
+        rebuild_prefilter()
+
+    results = []
+    to_frog = []
+    sampled = set()
 
     # First check if retweets are already processed in the cache
-    if retweet_id_str:
-        key = "t:%s" % retweet_id_str
-        rt = redis.get(key)
-        if rt:
-            kw, groups, tokens = json.loads(rt)
-            insert_tweet.apply_async((id_str, kw, groups, tokens), queue="master")
-            redis.expire(key, rt_cache_time)
-            return
+    rt_keys = ["t:%s" % rt_id_str for (_, _, rt_id_str) in tweets if rt_id_str]
+    cached = dict(zip(rt_keys, redis.mget(rt_keys))) if rt_keys else {}
+    for (id_str, text, retweet_id_str) in tweets:
+        if retweet_id_str:
+            key = "t:%s" % retweet_id_str
+            rt = cached.get(key)
+            if rt:
+                kw, groups, tokens = json.loads(rt)
+                results.append((id_str, kw, groups, tokens))
+                redis.expire(key, rt_cache_time)
+                continue
+
+        if may_contain_keyword(text):
+            to_frog.append((id_str, text, retweet_id_str))
+        elif random() < prefilter_sample:
+            # Frog analyzes a sample of the tweets the prefilter skips: the
+            # keywords it finds in them are the recall that the prefilter loses,
+            # and their inflections are learned for its next build
+            to_frog.append((id_str, text, retweet_id_str))
+            sampled.add(id_str)
+        else:
+            results.append((id_str, [], [], tokenize(text)))
 
-    frog = get_frog()
     # tokens contains a list of dictionaries with frog's analysis per token
     # each dict has the keys "index", "lemma", "pos", "posprob" and "text"
     # where "text" is the original text
-    tokens = frog.process(text)
+    # Frog only analyzes the texts that aren't in the cache, once per batch:
+    # bots and copy-paste campaigns send many tweets with the same text
+    keys = [text_key(text) for (_, text, _) in to_frog]
+    unique = list(OrderedDict.fromkeys(keys))
+    frog_cache.stats["batch"] += len(keys) - len(unique)
+    analyses = frog_cache.get_many(unique)
+    missing = OrderedDict((key, text) for (key, (_, text, _)) in zip(keys, to_frog) if key not in analyses)
+    new = list(zip(missing, frog_process(list(missing.values()))))
+    analyses.update(new)
+    if new:
+        frog_cache.put_many(new)
+    for ((id_str, text, retweet_id_str), key) in zip(to_frog, keys):
+        tokens = analyses[key]
+        # the keywords are matched every time, they may have changed since the text was cached
+        kw, groups = match_keywords(tokens)
+        results.append((id_str, kw, groups, tokens))
+        if id_str in sampled:
+            prefilter_stats["sampled"] += 1
+            if kw:
+                prefilter_stats["missed"] += 1
+
+        # put retweets in the cache
+        if retweet_id_str:
+            data = [kw, groups, tokens]
+            redis.set("t:%s" % retweet_id_str, json.dumps(data), ex=rt_cache_time)
+    return results
+
+
+# a token to separate the tweets that are analyzed in one frog call
+SEPARATOR = "HORTIRADARSEPARATOR"
+
+def frog_process(texts):
+    """Returns the frog tokens for each text."""
+    frog = get_frog()
+    if len(texts) <= 1 or any(SEPARATOR in text for text in texts):
+        return [frog.process(text) for text in texts]
+    # separate the texts with blank lines, so frog doesn't join sentences of different tweets
+    tokens = frog.process("\n\n{}\n\n".format(SEPARATOR).join(texts))
+    analyses = [[]]
+    for t in tokens:
+        if t["text"] == SEPARATOR:
+            analyses.append([])
+        else:
+            analyses[-1].append(t)
+    if len(analyses) != len(texts):
+        return [frog.process(text) for text in texts]
+    return analyses
+
+
+def match_keywords(tokens):
+    """Returns the keywords and their groups in the frog tokens."""
     kw = []
     groups = []
     for (i, t) in enumerate(tokens):
@@ -63,13 +338,11 @@ def find_keywords_and_groups(id_str, text, retweet_id_str):
 
             kw.append(lemma)
             groups += k.groups
-    kw, groups = list(set(kw)), list(set(groups))
-    insert_tweet.apply_async((id_str, kw, groups, tokens), queue="master")
 
-    # put retweets in the cache
-    if retweet_id_str:
-        data = [kw, groups, tokens]
-        redis.set(key, json.dumps(data), ex=rt_cache_time)
+            # remember inflections the prefilter doesn't know yet for its next build
+            if not may_contain_keyword(t["text"]):
+                redis.sadd("kf:" + lemma, t["text"].lower())
+    return list(set(kw)), list(set(groups))
 
 
 @app.task
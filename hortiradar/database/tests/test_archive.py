@@ -0,0 +1,35 @@
+"""Tests of the counts in the archive of old months.
+
+    python -m pytest hortiradar/database/tests
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """The archive module with June 2017 archived in a temporary directory."""
+    from hortiradar.database import archive
+
+    monkeypatch.setattr(archive, "archive_dir", str(tmp_path))
+    archive.load_month.cache_clear()
+    start = datetime(2017, 6, 1)
+    tweets = [{
+        "datetime": start + timedelta(minutes=20 * i),
+        "tweet": {"user": {"id_str": str(i % 3)}},
+        "keywords": ["tulp"] if i % 2 else ["roos", "tulp"],
+        "tokens": [{"lemma": "tulp"}],
+    } for i in range(6)]
+    np.savez_compressed(archive.month_file(start), **archive.columns(tweets))
+    yield archive
+    archive.load_month.cache_clear()
+
+
+def test_count_keywords_of_partial_hours(archive):
+    """The tweets of the edge hours of /keywords that the rollups don't count."""
+    assert archive.count_keywords(datetime(2017, 6, 1, 0, 30), datetime(2017, 6, 1, 1, 30)) == {"tulp": 3, "roos": 2}
+    assert archive.count_keywords(datetime(2017, 6, 1), datetime(2017, 6, 1, 1), {"roos"}) == {"roos": 2}
+    assert archive.count_keywords(datetime(2017, 7, 1), datetime(2017, 7, 2)) == {}
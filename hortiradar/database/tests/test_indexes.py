@@ -0,0 +1,76 @@
+"""Checks with explain() that the queries of the keyword resources, which
+filter spam in MongoDB, use the keywords index without a blocking sort. Needs
+a MongoDB on localhost (it uses and drops the `twitter_test_indexes`
+database), the tests are skipped without one.
+
+    python -m pytest hortiradar/database/tests
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+
+KEYWORDS_INDEX = "keywords_1_datetime_1__id_1_spam_1"
+
+
+@pytest.fixture(scope="module")
+def tweets():
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("MongoDB is not reachable")
+    from hortiradar.database.partitions import create_tweets_indexes
+
+    db = client.twitter_test_indexes
+    start = datetime(2017, 6, 1)
+    db.tweets.insert_many([{
+        "tweet": {"id_str": str(i)},
+        "keywords": ["tulp"] if i % 2 else ["roos", "tulp"],
+        "num_keywords": 1 if i % 2 else 2,
+        "groups": ["bloemen"],
+        "datetime": start + timedelta(minutes=i),
+        **({"spam": 0.8} if i % 7 == 0 else {}),
+    } for i in range(1000)])
+    create_tweets_indexes(db.tweets)
+    yield db.tweets
+    client.drop_database(db.name)
+
+
+def index_stages(plan):
+    """The names of the indexes scanned in a query plan."""
+    if plan.get("stage") == "IXSCAN":
+        yield plan["indexName"]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            yield from index_stages(child)
+
+
+def keyword_query(start, end):
+    """The query of the keyword resources without spam, as api.keyword_query."""
+    from hortiradar.database.rollups import spam_level
+    return {"keywords": "tulp", "datetime": {"$gte": start, "$lt": end}, "spam": {"$not": {"$gt": spam_level}}}
+
+
+def first_page(tweets, query):
+    return tweets.find(query).sort([("datetime", 1), ("_id", 1)]).limit(100)
+
+
+def next_page(tweets, query):
+    after = first_page(tweets, query)[99]
+    query = dict(query, **{"$or": [{"datetime": {"$gt": after["datetime"]}},
+                                   {"datetime": after["datetime"], "_id": {"$gt": after["_id"]}}]})
+    return first_page(tweets, query)
+
+
+@pytest.mark.parametrize("cursor", [
+    lambda tweets, query: tweets.find(query),
+    first_page,
+    next_page,
+], ids=["find", "page", "next_page"])
+def test_keyword_queries_use_the_keywords_index(tweets, cursor):
+    query = keyword_query(datetime(2017, 6, 1, 2), datetime(2017, 6, 1, 12))
+    winning = cursor(tweets, query).explain()["queryPlanner"]["winningPlan"]
+    assert KEYWORDS_INDEX in index_stages(winning)
+    assert "SORT" not in str(winning)
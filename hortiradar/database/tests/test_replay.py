@@ -0,0 +1,105 @@
+"""Replays the recorded stream in data/stream.jsonl through the ingest pipeline,
+with in-memory stand-ins for MongoDB and redis (pip install mongomock fakeredis),
+see replay.py. The recording has statuses and delete notices: of tweets with
+and without keywords, right after the tweet and later, of the last tweet and of
+a tweet that was never received.
+
+    python -m pytest hortiradar/database/tests
+"""
+import json
+import shutil
+import sys
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+
+import pytest
+
+pytest.importorskip("fakeredis")
+pytest.importorskip("mongomock")
+
+DATABASE_DIR = dirname(dirname(abspath(__file__)))
+RECORDING = join(dirname(abspath(__file__)), "data", "stream.jsonl")
+
+
+@pytest.fixture(scope="module")
+def pipeline(tmp_path_factory):
+    """The replay module, with the pipeline on in-memory databases."""
+    import fakeredis
+    import mongomock
+
+    sys.path.insert(0, DATABASE_DIR)  # the scripts import each other as top-level modules
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("streamer"))  # the streamer logs to twitter.log
+        import replay
+
+        mongo = mongomock.MongoClient()
+        redis, worker_redis = fakeredis.FakeStrictRedis(db=15), fakeredis.FakeStrictRedis(db=14)
+        keywords = replay.load_keywords([join(DATABASE_DIR, "data", "flowers.txt"),
+                                         join(DATABASE_DIR, "data", "fruitsandveg.txt")])
+        replay.configure(mongo.twitter_replay, redis, worker_redis, keywords)
+        yield replay, mongo, redis, worker_redis
+        replay.reset(mongo, redis, worker_redis)
+
+
+@pytest.mark.parametrize("use_log", [False, True], ids=["redis", "ingest_log"])
+@pytest.mark.parametrize("batch_size", [1, 5])
+@pytest.mark.parametrize("behind", [False, True], ids=["", "behind"])
+def test_deleted_tweets_are_not_inserted(pipeline, monkeypatch, batch_size, use_log, behind):
+    """The deletes go to the master as they come, so with batches they arrive
+    before the tweets. When the master is behind, the expiring tombstones are
+    gone before it inserts the tweets."""
+    replay, mongo, redis, worker_redis = pipeline
+    if behind:
+        send_deletes = replay.streamer.send_deletes
+
+        def send_and_expire(id_strs):
+            send_deletes(id_strs)
+            for key in redis.scan_iter("d:*"):
+                redis.delete(key)
+
+        monkeypatch.setattr(replay.streamer, "send_deletes", send_and_expire)
+    log_dir = mkdtemp(prefix="replay-") if use_log else None
+    try:
+        replay.reset(mongo, redis, worker_redis, log_dir)
+        messages = replay.read_messages(RECORDING, 0)
+        replay.replay(messages, batch_size, delete_batch_size=1)
+
+        ids, deleted = replay.status_ids(messages)
+        stored = replay.stored_ids(mongo.twitter_replay)
+        assert len(deleted & ids) == 4
+        assert not stored & deleted
+        assert stored == ids - deleted
+        assert replay.num_staged(redis) == 0
+        assert replay.metrics.backlog(redis) == 0
+    finally:
+        if log_dir:
+            shutil.rmtree(log_dir)
+
+
+def test_broadcast_changes_the_keywords_of_the_workers(pipeline, monkeypatch):
+    """announce_keywords reaches the copy of tasks_workers that runs
+    find_keywords_and_groups, not only the package's copy."""
+    replay, mongo, redis, worker_redis = pipeline
+    from hortiradar.database.keywords import Keyword, announce_keywords
+
+    tasks_workers = replay.tasks_workers
+    replay.reset(mongo, redis, worker_redis)
+    with open(RECORDING) as f:
+        j = json.loads(f.readline())
+    j["text"] = "Vandaag een kweepeer gekocht"
+
+    def send(id_str):
+        redis.set("t:" + id_str, json.dumps(dict(j, id_str=id_str)))
+        tasks_workers.find_keywords_and_groups.apply_async((id_str, j["text"], None), queue="workers")
+        return replay.tasks_master.db.tweets.find_one({"tweet.id_str": id_str})["keywords"]
+
+    keywords = dict(tasks_workers.keywords, kweepeer=Keyword(lemma="kweepeer", pos="N", groups=["fruitsandveg"]))
+    monkeypatch.setattr(tasks_workers, "get_keywords", lambda: keywords)
+    try:
+        assert send("1") == []
+        announce_keywords(redis)
+        assert tasks_workers.keywords_version == 1
+        assert send("2") == ["kweepeer"]
+    finally:
+        monkeypatch.undo()
+        tasks_workers.refresh_keywords(0)
@@ -0,0 +1,28 @@
+"""Tests of the hourly keyword counts.
+
+    python -m pytest hortiradar/database/tests
+"""
+from datetime import timedelta
+
+from hortiradar.database.rollups import step_bases
+
+
+def seconds(*steps):
+    return [timedelta(seconds=s) for s in steps]
+
+
+def test_steps_of_whole_hours_are_counted_together():
+    assert step_bases(seconds(3600, 7200, 86400)) == [(timedelta(hours=1), seconds(3600, 7200, 86400))]
+    assert step_bases(seconds(7200, 10800)) == [(timedelta(hours=1), seconds(7200, 10800))]
+
+
+def test_mixed_steps_keep_the_hours_in_the_rollups():
+    """With step=7,3600 the greatest common divisor is a second: the hourly
+    series is counted in hours (from the rollups) and the other on its own."""
+    bases = step_bases(seconds(7, 3600))
+    assert bases == [(timedelta(hours=1), seconds(3600)), (timedelta(seconds=7), seconds(7))]
+    assert all(dt % base == timedelta(0) for (base, steps) in bases for dt in steps)
+
+
+def test_repeated_steps_are_counted_once():
+    assert step_bases(seconds(60, 60)) == [(timedelta(seconds=60), seconds(60))]
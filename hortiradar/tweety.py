@@ -1,14 +1,42 @@
+import json
+from collections import OrderedDict
+
 import requests
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 time_format = "%Y-%m-%dT%H:%M:%S"
 
+MSGPACK = "application/msgpack"
+MSGPACK_STREAM = "application/x-msgpack-stream"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
 
 class Tweety:
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, use_msgpack=False):
+        """With `use_msgpack` the API is asked to respond with MessagePack and
+        the methods return the decoded data instead of JSON strings.
+        """
         self.base_url = base_url
         self.token = token
         self.s = requests.Session()
+        self.use_msgpack = use_msgpack and msgpack is not None
+        if self.use_msgpack:
+            self.s.headers["Accept"] = "{}, {};q=0.9, application/json;q=0.5".format(MSGPACK, MSGPACK_STREAM)
+        if zstandard is not None:
+            self.s.headers["Accept-Encoding"] = "zstd, gzip, deflate"
+
+        # conditional GET cache: (url, params) -> (etag, content, headers)
+        self.etag_cache = OrderedDict()
+        self.etag_cache_size = 32
 
         def wrap_api(method, uri_template, name=None):
             request = eval("self.s." + method)
@@ -17,16 +45,67 @@ class Tweety:
                 url = self.base_url + uri_template.format(*uri_params)
                 params["token"] = self.token
                 data = params.pop("data", None)
-                r = request(url, params=params, data=data)
-                # TODO: raise exception if request is unsuccessful
+                if method != "get":
+                    r = request(url, params=params, data=data)
+                    # TODO: raise exception if request is unsuccessful
+                    if r.content:
+                        return decode(r.content, r.headers)
+                    else:
+                        return r.status_code
+
+                key = (url, tuple(sorted((k, str(v)) for (k, v) in params.items())))
+                cached = self.etag_cache.get(key)
+                headers = {"If-None-Match": cached[0]} if cached else {}
+                r = request(url, params=params, headers=headers)
+                if r.status_code == 304 and cached:
+                    self.etag_cache.move_to_end(key)
+                    return decode(cached[1], cached[2])
+                etag = r.headers.get("ETag")
+                if etag and r.status_code == 200:
+                    self.etag_cache[key] = (etag, r.content, r.headers)
+                    if len(self.etag_cache) > self.etag_cache_size:
+                        self.etag_cache.popitem(last=False)
                 if r.content:
-                    return r.content
+                    return decode(r.content, r.headers)
                 else:
                     return r.status_code
 
             call.__name__ = name
             return call
 
+        def wrap_iter(uri_template, name=None):
+            """Iterates over the items of a list resource while they are being
+            streamed as newline delimited JSON (or MessagePack). With the
+            `limit` keyword argument the items are requested in pages of at
+            most limit items, the next page is only requested when the
+            previous is exhausted.
+            """
+            def call(*uri_params, **params):
+                url = self.base_url + uri_template.format(*uri_params)
+                params["token"] = self.token
+                # requests only decompresses gzip while streaming
+                headers = {"Accept": MSGPACK_STREAM if self.use_msgpack else "application/x-ndjson",
+                           "Accept-Encoding": "gzip"}
+                while True:
+                    with self.s.get(url, params=params, headers=headers, stream=True) as r:
+                        r.raise_for_status()
+                        if r.headers.get("Content-Type", "").startswith(MSGPACK_STREAM):
+                            unpacker = msgpack.Unpacker(raw=False)
+                            for chunk in r.iter_content(chunk_size=64 * 1024):
+                                unpacker.feed(chunk)
+                                yield from unpacker
+                        else:
+                            for line in r.iter_lines():
+                                if line:
+                                    yield json.loads(line.decode("utf-8"))
+                        after = r.headers.get("X-Next-Cursor")
+                    if not after:
+                        return
+                    params["after"] = after
+
+            call.__name__ = name
+            return call
+
         self.get_keywords = wrap_api("get", "/keywords", name="get_keywords")
         # tweety.get_keyword("bloemen", start=datetime..., end=datetime...)
         self.get_keyword = wrap_api("get", "/keywords/{}", name="get_keyword")
@@ -34,16 +113,42 @@ class Tweety:
         self.get_keyword_media = wrap_api("get", "/keywords/{}/media", name="get_keyword_media")
         self.get_keyword_urls = wrap_api("get", "/keywords/{}/urls", name="get_keyword_urls")
         self.get_keyword_texts = wrap_api("get", "/keywords/{}/texts", name="get_keyword_texts")
+        # for tweet in tweety.iter_keyword("bloemen", start=..., end=..., limit=1000)
+        self.iter_keyword = wrap_iter("/keywords/{}", name="iter_keyword")
+        self.iter_keyword_id = wrap_iter("/keywords/{}/ids", name="iter_keyword_id")
+        self.iter_keyword_media = wrap_iter("/keywords/{}/media", name="iter_keyword_media")
+        self.iter_keyword_urls = wrap_iter("/keywords/{}/urls", name="iter_keyword_urls")
+        self.iter_keyword_texts = wrap_iter("/keywords/{}/texts", name="iter_keyword_texts")
         self.get_keyword_users = wrap_api("get", "/keywords/{}/users", name="get_keyword_users")
         self.get_keyword_wordcloud = wrap_api("get", "/keywords/{}/wordcloud", name="get_keyword_wordcloud")
         # tweety.get_keyword_series("meloen", step=3600)
         self.get_keyword_series = wrap_api("get", "/keywords/{}/series", name="get_keyword_series")
+        # tweety.get_keywords_series(keywords="meloen,tulp", step=3600) or with group="bloemen"
+        self.get_keywords_series = wrap_api("get", "/series", name="get_keywords_series")
         self.get_groups = wrap_api("get", "/groups", name="get_groups")
         self.post_groups = wrap_api("post", "/groups", name="post_groups")
         self.get_group = wrap_api("get", "/groups/{}", name="get_group")
         self.put_group = wrap_api("put", "/groups/{}", name="put_group")
         self.delete_group = wrap_api("delete", "/groups/{}", name="delete_group")
+        self.get_registry = wrap_api("get", "/registry", name="get_registry")
         self.get_tweet = wrap_api("get", "/tweet/{}", name="get_tweet")
         self.delete_tweet = wrap_api("delete", "/tweet/{}", name="delete_tweet")
         #  tweety.patch_tweet(id_str, data=json.dumps({"spam": 1.0}))
         self.patch_tweet = wrap_api("patch", "/tweet/{}", name="patch_tweet")
+
+
+def decode(content, headers):
+    """The content of a response: MessagePack is decoded, JSON is returned as
+    is (bytes)."""
+    # newer versions of urllib3 already decompress zstd
+    if headers.get("Content-Encoding") == "zstd" and content.startswith(ZSTD_MAGIC):
+        content = zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    content_type = headers.get("Content-Type", "").split(";")[0]
+    if content_type == MSGPACK:
+        return msgpack.unpackb(content, raw=False)
+    elif content_type == MSGPACK_STREAM:
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(content)
+        return list(unpacker)
+    else:
+        return content
@@ -16,6 +16,7 @@ from wtforms.validators import AnyOf
 
 from hortiradar import TOKEN, Tweety, time_format
 from hortiradar.database import lemmatize
+from hortiradar.database.statistics import read_stats
 from hortiradar.website import app, db
 
 from forms import GroupForm, RoleForm
@@ -461,7 +462,7 @@ def view_stories(group):
 
 @bp.route("/about")
 def about():
-    stats = json.loads(redis.get("t:stats"))
+    stats = read_stats(redis)
     return render_template("about.html", title="Over de Hortiradar", **stats)
 
 @bp.route("/docs/api")
@@ -83,20 +83,27 @@ def get_wordcloud(kw, s):
     return terms
 
 
-def get_ts(kw, s, e):
-    jstr = tweety.get_keyword_series(kw, step=3600, start=datetime.strftime(s, time_format), end=datetime.strftime(e, time_format)).decode("utf-8")
-    if "Internal Server Error" not in jstr:
-        res = json.loads(jstr)
-        nh = num_hours(datetime.strptime(res["end"], time_format) - datetime.strptime(res["start"], time_format))
-        ts = np.transpose([res["series"][str(k)] if str(k) in res["series"] else 0 for k in range(nh)])
-        ans_s = datetime.strptime(res["start"], time_format)
-        ans_e = datetime.strptime(res["end"], time_format)
-        if ans_s != s:
-            ts = np.append(np.ones(num_hours(ans_s - s)), ts)
-        if ans_e != e:
-            ts = np.append(ts, np.ones(num_hours(e - ans_e)))
-    else:
-        ts = []
+def get_all_ts(kws, s, e, chunk_size=200):
+    """Hourly time series of all keywords from s to e, with one request per chunk of keywords."""
+    all_ts = {}
+    for i in range(0, len(kws), chunk_size):
+        jstr = tweety.get_keywords_series(keywords=",".join(kws[i:i + chunk_size]), step=3600, start=datetime.strftime(s, time_format), end=datetime.strftime(e, time_format)).decode("utf-8")
+        try:
+            res = json.loads(jstr)
+        except ValueError:
+            continue
+        for (kw, counts) in zip(res["keywords"], res["series"]):
+            all_ts[kw] = pad_ts(counts)
+    return all_ts
+
+
+def pad_ts(counts):
+    # the hours before the first tweet and after the last are padded with ones
+    ts = np.array(counts, dtype=float)
+    filled = np.flatnonzero(ts)
+    if len(filled):
+        ts[:filled[0]] = 1
+        ts[filled[-1] + 1:] = 1
     return ts
 
 
@@ -104,7 +111,7 @@ def num_hours(td):
     return 24*td.days + td.seconds//3600
 
 
-def check_for_peak(kw, now, begin):
+def check_for_peak(kw, now, begin, timeseries):
     s = round_time(begin, "day")
     e = round_time(now, "day", rounding="ceil")
 
@@ -112,8 +119,7 @@ def check_for_peak(kw, now, begin):
     df["hours"] = [s + timedelta(hours=x) for x in range(num_hours(e-s))]
     df.set_index("hours", inplace=True)
 
-    timeseries = get_ts(kw, s, now)
-    if timeseries != []:
+    if timeseries is not None:
         missing_hours = num_hours(e-s) - len(timeseries)
         df[kw] = np.append(timeseries, [np.nan] * missing_hours)
 
@@ -178,9 +184,10 @@ def main():
     peaks = []
     terms = {}
 
+    all_ts = get_all_ts(sorted(keywords), s, end)
     for kw in keywords:
         try:
-            df_kw, peak = check_for_peak(kw, end, start)
+            df_kw, peak = check_for_peak(kw, end, start, all_ts.get(kw))
             if peak:
                 peaks.append(kw)
                 peak_df = pd.concat([peak_df, df_kw], axis=1)
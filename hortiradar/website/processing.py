@@ -19,7 +19,7 @@ from pattern.nl import sentiment
 
 from hortiradar import Tweety, TOKEN, time_format
 from hortiradar.clustering import Token
-from hortiradar.database import stop_words, obscene_words, blacklist, get_db
+from hortiradar.database import stop_words, blacklist, get_db
 from utils import floor_time
 
 db = get_db()
@@ -30,7 +30,8 @@ broker_url = "amqp://guest@localhost:5672/hortiradar"
 app = Celery("tasks", broker=broker_url)
 app.conf.update(task_ignore_result=True, worker_prefetch_multiplier=2)
 
-tweety = Tweety("http://127.0.0.1:8888", TOKEN)
+# only used through cache, which handles the decoded MessagePack
+tweety = Tweety("http://127.0.0.1:8888", TOKEN, use_msgpack=True)
 redis = StrictRedis()
 
 CACHE_TIME = 60 * 60
@@ -88,6 +89,8 @@ def cache_request(func, args, kwargs, cache_time, key, loading_id):
 
 @app.task(name="tasks.mark_as_spam")
 def mark_as_spam(ids: Sequence[str]):
+    """Mark the tweets with images that aren't safe for work as spam, the API
+    leaves them out from then on. The master scores the other spam."""
     for id_str in ids:
         tweety.patch_tweet(id_str, data=json.dumps({"spam": 0.8}))
 
@@ -138,7 +141,7 @@ def process_top(group, max_amount, params, force_refresh=False, cache_time=CACHE
     return topkArray
 
 def process_tokens(prod, params, force_refresh=False, cache_time=CACHE_TIME):
-    tweets = cache(tweety.get_keyword, prod, force_refresh=force_refresh, cache_time=CACHE_TIME, **params)
+    tweets = cache(tweety.get_keyword, prod, fields="lemmas,pos", force_refresh=force_refresh, cache_time=CACHE_TIME, **params)
 
     token_dict = Counter()
 
@@ -160,7 +163,8 @@ def process_tokens(prod, params, force_refresh=False, cache_time=CACHE_TIME):
 
 
 def process_details(prod, params, force_refresh=False, cache_time=CACHE_TIME):
-    tweets = cache(tweety.get_keyword, prod, force_refresh=force_refresh, cache_time=CACHE_TIME, **params)
+    fields = "id_str,created_at,user,retweet,reply,entities,lemmas,words"
+    tweets = cache(tweety.get_keyword, prod, fields=fields, force_refresh=force_refresh, cache_time=CACHE_TIME, **params)
 
     tweetList = []
     unique_tweets = {}
@@ -171,7 +175,6 @@ def process_details(prod, params, force_refresh=False, cache_time=CACHE_TIME):
     word_cloud_dict = Counter()
     tsDict = Counter()
     mapLocations = []
-    spam_list = []
     image_tweet_id = {}
     nodes = {}
     edges = []
@@ -181,17 +184,11 @@ def process_details(prod, params, force_refresh=False, cache_time=CACHE_TIME):
         tweet = tw["tweet"]
         lemmas = [t["lemma"] for t in tw["tokens"]]
         texts = [t["text"].lower() for t in tw["tokens"]]  # unlemmatized words
-        words = list(set(lemmas + texts))                  # to check for obscene words
 
         dt = datetime.strptime(tweet["created_at"], "%a %b %d %H:%M:%S +0000 %Y")
         tsDict.update([(dt.year, dt.month, dt.day, dt.hour)])
         tweets[i]["tweet"]["datetime"] = datetime(dt.year, dt.month, dt.day, dt.hour)  # round to hour for peak detection
 
-        # check for spam
-        if any(obscene_words.get(t) for t in words):
-            spam_list.append(tweet["id_str"])
-            continue
-
         tweetList.append(tweet["id_str"])
         word_cloud_dict.update(lemmas)
 
@@ -264,8 +261,6 @@ def process_details(prod, params, force_refresh=False, cache_time=CACHE_TIME):
         except KeyError:
             pass
 
-    mark_as_spam.apply_async((spam_list,), queue="web")
-
     def is_stop_word(token):
         t = token.lower()
         return (len(t) <= 1) or (t.startswith("https://") or t.startswith("http://")) or (t in stop_words)
@@ -343,7 +338,8 @@ def process_details(prod, params, force_refresh=False, cache_time=CACHE_TIME):
             nsfw_list.append(image_tweet_id[url])
         elif status == 200:
             images.append({"link": url, "occ": count})
-    mark_as_spam.apply_async((nsfw_list,), queue="web")
+    if nsfw_list:
+        mark_as_spam.apply_async((nsfw_list,), queue="web")
 
     urls = []
     for (url, count) in Counter(URLList).most_common():